@@ -0,0 +1,210 @@
+""" Measure the client against a local mock MPX server.
+
+    python benchmarks/bench_client.py             # compare with baseline.json
+    python benchmarks/bench_client.py --save      # record a new baseline
+    python benchmarks/bench_client.py --check     # exit 1 on regressions
+
+Each scenario reports throughput, latency percentiles of its operations
+and the peak memory allocated while running it (measured in a separate
+run under ``tracemalloc`` so it doesn't skew the timings). Results are
+compared with ``baseline.json``; a throughput drop or a latency or memory
+increase beyond ``--tolerance`` is reported as a regression. Baselines are
+only comparable on the machine that recorded them.
+
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mediaamp.metrics import MetricsCollector, percentile  # noqa: E402
+from mock_server import MockMPXServer  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# metric: whether higher values are better
+COMPARED = {'ops_per_s': True, 'p95_ms': False, 'peak_kb': False}
+
+
+def single_get(server, session, size):
+    media = session['Media Data Service'].Media
+    return [lambda i=i: media.get(str(i % server.total + 1)) for i in range(size)]
+
+
+def paged_scan(server, session, size):
+    media = session['Media Data Service'].Media
+    return [lambda: sum(1 for _ in media.iter_all(page_size=500)) for _ in range(max(size // 100, 1))]
+
+
+def scan_retained(server, session, size):
+    """ A scan keeping every entry, as full dicts. """
+    media = session['Media Data Service'].Media
+    return [lambda: list(media.iter_all(page_size=500)) for _ in range(max(size // 100, 1))]
+
+
+def projected_scan(server, session, size):
+    """ The same scan with ``fields`` and compact records. """
+    media = session['Media Data Service'].Media
+    fields = ['id', 'title', 'updated', 'pl1$show']
+    return [lambda: list(media.iter_all(page_size=500, fields=fields, records=True))
+            for _ in range(max(size // 100, 1))]
+
+
+def concurrent_scan(server, session, size):
+    media = session['Media Data Service'].Media
+    return [lambda: sum(1 for _ in media.fetch_all(page_size=250, workers=8))
+            for _ in range(max(size // 100, 1))]
+
+
+def bulk_write(server, session, size):
+    media = session['Media Data Service'].Media
+    entries = [{'id': 'http://data.media.theplatform.com/media/data/Media/%d' % i,
+                'title': 'Updated %d' % i} for i in range(1, size * 2 + 1)]
+    return [lambda: list(media.bulk_update(entries, batch_size=100, workers=4))
+            for _ in range(5)]
+
+
+def notification_poll(server, session, size):
+    from mediaamp.sync import NotificationSync
+    sync = NotificationSync(session, {'Media Data Service': ['Media']}, block=False)
+    sync.poll()
+    sync.commit()
+
+    def poll():
+        sync.poll()
+        sync.commit()
+    return [poll for _ in range(max(size // 20, 1))]
+
+
+def token_expiry(server, session, size, threads=8):
+    """ Threads hammering a session whose token keeps expiring. """
+    media = session['Media Data Service'].Media
+    server.token_ttl = 0.25
+
+    def worker():
+        for i in range(size // threads):
+            media.get(str(i % server.total + 1))
+
+    def run():
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+    return [run for _ in range(3)]
+
+
+SCENARIOS = (single_get, paged_scan, scan_retained, projected_scan, concurrent_scan, bulk_write,
+             notification_poll, token_expiry)
+
+
+def measure(scenario, size, latency, entry_size, trace=False):
+    with MockMPXServer(total=2000, latency=latency, entry_size=entry_size) as server:
+        session = server.session()
+        metrics = MetricsCollector().attach(session)
+        operations = scenario(server, session, size)
+        session.refresh_token()
+        if trace:
+            tracemalloc.start()
+        durations = []
+        started = time.time()
+        for operation in operations:
+            op_started = time.time()
+            operation()
+            durations.append(time.time() - op_started)
+        elapsed = time.time() - started
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        requests = sum(s['count'] for s in metrics.summary().values())
+        session.close()
+        durations.sort()
+        return {
+            'operations': len(operations),
+            'requests': requests,
+            'sign_ins': server.sign_ins,
+            'ops_per_s': len(operations) / elapsed,
+            'requests_per_s': requests / elapsed,
+            'p50_ms': percentile(durations, 0.5) * 1000,
+            'p95_ms': percentile(durations, 0.95) * 1000,
+            'p99_ms': percentile(durations, 0.99) * 1000,
+            'peak_kb': peak / 1024.0,
+        }
+
+
+def run(size=200, latency=0.0, entry_size=None, repeat=3):
+    """ Run every scenario ``repeat`` times and keep the median of each metric. """
+    results = {}
+    for scenario in SCENARIOS:
+        runs = [measure(scenario, size, latency, entry_size) for _ in range(repeat)]
+        result = dict((metric, _median([r[metric] for r in runs])) for metric in runs[0])
+        result['peak_kb'] = measure(scenario, size, latency, entry_size, trace=True)['peak_kb']
+        results[scenario.__name__] = result
+    return results
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        for metric, higher_is_better in sorted(COMPARED.items()):
+            expected = baseline.get(name, {}).get(metric)
+            if not expected:
+                continue
+            change = (result[metric] - expected) / expected
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, metric, expected, result[metric], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=200, help='operations per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency in ms')
+    parser.add_argument('--entry-size', type=int, default=None, help='bytes per object')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='store the results as baseline')
+    parser.add_argument('--check', action='store_true', help='exit 1 on regressions')
+    args = parser.parse_args(argv)
+
+    results = run(args.size, args.latency / 1000.0, args.entry_size, args.repeat)
+    print('%-18s %9s %9s %9s %9s %9s %8s %10s' % (
+        'scenario', 'ops/s', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sign-ins', 'peak KB'))
+    for name, r in sorted(results.items()):
+        print('%-18s %9.1f %9.1f %9.2f %9.2f %9.2f %8d %10.1f' % (
+            name, r['ops_per_s'], r['requests_per_s'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['sign_ins'], r['peak_kb']))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            rounded = dict(
+                (name, dict((k, round(v, 3)) for k, v in r.items())) for name, r in results.items()
+            )
+            json.dump(rounded, f, indent=2, sort_keys=True)
+        print('\nBaseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('\nNo baseline at %s, run with --save to record one.' % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for name, metric, expected, actual, change in regressions:
+        print('REGRESSION %s %s: %.2f -> %.2f (%+.0f%%)' % (name, metric, expected, actual, change * 100))
+    if not regressions:
+        print('\nNo regressions against %s' % args.baseline)
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+""" Compare the installed JSON codecs on Media feed payloads.
+
+    python benchmarks/bench_codecs.py
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mediaamp.jsoncodec import JSONCodec, available_codecs  # noqa: E402
+from payloads import media_feed  # noqa: E402
+
+SIZES = (1, 100, 1000)
+
+
+def bench_codec(codec, payload, body, number):
+    loads = min(timeit.repeat(lambda: codec.loads(body), number=number, repeat=3)) / number
+    dumps = min(timeit.repeat(lambda: codec.dumps(payload), number=number, repeat=3)) / number
+    return loads, dumps
+
+
+def run(sizes=SIZES):
+    results = []
+    for size in sizes:
+        payload = media_feed(size)
+        body = JSONCodec().dumps(payload)
+        number = max(1, 2000 // size)
+        for codec in available_codecs():
+            loads, dumps = bench_codec(codec, payload, body, number)
+            results.append({
+                'codec': codec.name,
+                'entries': size,
+                'bytes': len(body),
+                'loads_ms': loads * 1000,
+                'dumps_ms': dumps * 1000,
+            })
+    return results
+
+
+def main():
+    print('%-8s %8s %11s %10s %10s' % ('codec', 'entries', 'bytes', 'loads ms', 'dumps ms'))
+    for row in run():
+        print('%(codec)-8s %(entries)8d %(bytes)11d %(loads_ms)10.3f %(dumps_ms)10.3f' % row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+""" A local stand-in for the MPX endpoints used by the benchmarks.
+
+Serves ``resolveDomain``, ``signIn``, paged data feeds (``range``,
+``count`` and ``fields``), object GETs, feed PUT/POST and the ``notify`` endpoint over
+HTTP/1.1 keep-alive connections. Every response is delayed by ``latency``
+seconds, objects are padded to ``entry_size`` bytes and tokens stop being
+accepted ``token_ttl`` seconds after being issued, like MPX does with an
+``InvalidTokenException`` body.
+
+    with MockMPXServer(total=5000, latency=0.01) as server:
+        session = server.session()
+        session['Media Data Service'].Media.get(params={'range': '1-100'})
+
+"""
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mediaamp  # noqa: E402
+from payloads import media_entry  # noqa: E402
+
+REGISTRY_FILE = os.path.join(os.path.dirname(__file__), '..', 'service_registry.json')
+INVALID_TOKEN = {
+    'isException': True,
+    'responseCode': 401,
+    'title': 'com.theplatform.authentication.api.exception.InvalidTokenException',
+    'description': 'Invalid security token.',
+}
+
+
+class MockMPXServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, total=1000, latency=0.0, entry_size=None, token_ttl=3600,
+                 notifications_per_poll=100, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockMPXHandler)
+        self.total = total
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.notifications_per_poll = notifications_per_poll
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.sign_ins = 0
+        self.requests = 0
+        self.sequence = 0
+        rng = random.Random(seed)
+        self.objects = [_pad(media_entry(i, rng), entry_size) for i in range(1, total + 1)]
+        self.entries = [_encode(entry) for entry in self.objects]
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def registry(self):
+        with open(REGISTRY_FILE) as f:
+            registry = json.load(f)
+        return dict(
+            (key, self.url + urlparse(value).path) for key, value in registry.items()
+        )
+
+    def session(self, **kwargs):
+        """ A ``mediaamp.Session`` talking to this server. """
+        session = mediaamp.Session('bench', 'bench', 'http://access.auth.theplatform.com/data/Account/1',
+                                   service_registry=self.registry(), use_ssl=False, **kwargs)
+        session.signin_url = self.url + '/idm/web/Authentication/signIn'
+        session.registry_url = self.url + '/web/Registry/resolveDomain'
+        return session
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def issue_token(self):
+        with self.lock:
+            self.sign_ins += 1
+            token = 'token-%d' % self.sign_ins
+            self.tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def valid_token(self, token):
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def notifications(self, since):
+        with self.lock:
+            if since is None:
+                return [{'id': self.sequence}]
+            notifications = []
+            for _ in range(self.notifications_per_poll):
+                self.sequence += 1
+                media_id = self.sequence % self.total + 1
+                notifications.append({
+                    'id': self.sequence,
+                    'method': 'put',
+                    'type': 'Media',
+                    'entry': {'id': 'http://data.media.theplatform.com/media/data/Media/%d' % media_id},
+                })
+            return notifications
+
+
+class MockMPXHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('get')
+
+    def do_PUT(self):
+        self.handle_request('put')
+
+    def do_POST(self):
+        self.handle_request('post')
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path.endswith('/signIn'):
+            return self.reply({'signInResponse': {'token': server.issue_token()}})
+        if not server.valid_token(self.token()):
+            return self.reply(INVALID_TOKEN)
+        if url.path.endswith('/resolveDomain'):
+            return self.reply({'resolveDomainResponse': server.registry()})
+        if url.path.endswith('/notify'):
+            return self.reply(server.notifications(params.get('since')))
+        if method in ('put', 'post'):
+            feed = json.loads(body.decode('utf-8'))
+            return self.reply({'entries': feed.get('entries', [])})
+
+        object_id = url.path.rsplit('/data/Media', 1)[-1].strip('/')
+        if object_id:
+            return self.send_body(server.entries[(int(object_id) - 1) % server.total])
+        return self.send_body(self.feed(params))
+
+    def feed(self, params):
+        entries = self.server.entries
+        ids = params.get('byId')
+        if ids:
+            page = [entries[(int(i) - 1) % len(entries)] for i in ids.split('|')]
+            start = 1
+        else:
+            first, _, last = params.get('range', '1-500').partition('-')
+            start = int(first)
+            page = entries[start - 1:int(last)]
+            if params.get('fields'):
+                fields = params['fields'].split(',')
+                page = [
+                    _encode(dict((f, entry[f]) for f in fields if f in entry))
+                    for entry in self.server.objects[start - 1:int(last)]
+                ]
+        header = {'startIndex': start, 'itemsPerPage': len(page), 'entryCount': len(page)}
+        if params.get('count') == 'true':
+            header['totalResults'] = len(entries)
+        header = _encode(header)
+        return header[:-1] + b',"entries":[' + b','.join(page) + b']}'
+
+    def token(self):
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Basic '):
+            return None
+        credentials = base64.b64decode(authorization[6:]).decode('utf-8')
+        return credentials.split(':', 1)[-1]
+
+    def reply(self, payload):
+        self.send_body(_encode(payload))
+
+    def send_body(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _encode(payload):
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def _pad(entry, entry_size):
+    if entry_size:
+        missing = entry_size - len(_encode(entry))
+        if missing > 0:
+            entry['pl1$padding'] = 'x' * missing
+    return entry
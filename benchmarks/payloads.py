@@ -0,0 +1,67 @@
+""" Representative MPX payloads for benchmarks. """
+import random
+
+ACCOUNT = 'http://access.auth.theplatform.com/data/Account/2000000000'
+MEDIA_URL = 'http://data.media.theplatform.com/media/data/Media/%d'
+
+
+def media_entry(media_id, rng=random):
+    """ A cjson Media object with files, thumbnails, categories and custom fields. """
+    updated = 1435037606000 + media_id * 1000
+    return {
+        'id': MEDIA_URL % media_id,
+        'guid': 'guid-%d' % media_id,
+        'title': 'Media item %d' % media_id,
+        'description': ' '.join('lorem%d' % rng.randint(0, 999) for _ in range(40)),
+        'ownerId': ACCOUNT,
+        'added': updated - 86400000,
+        'updated': updated,
+        'availableDate': updated,
+        'expirationDate': 0,
+        'approved': True,
+        'locked': False,
+        'keywords': 'news, sports, video',
+        'categories': [
+            {'name': 'Category %d' % rng.randint(0, 50), 'scheme': '', 'label': ''}
+            for _ in range(3)
+        ],
+        'content': [
+            {
+                'id': 'http://data.media.theplatform.com/media/data/MediaFile/%d%d' % (media_id, i),
+                'url': 'http://link.theplatform.com/s/abc/media_%d_%d.mp4' % (media_id, i),
+                'format': 'MPEG4',
+                'contentType': 'video',
+                'duration': rng.uniform(30, 3600),
+                'bitrate': rng.choice([400000, 800000, 1500000, 3000000]),
+                'width': 1280,
+                'height': 720,
+                'fileSize': rng.randint(10 ** 6, 10 ** 9),
+                'assetTypes': ['Mezzanine', 'Web'],
+                'releases': [{'pid': 'pid%d%d' % (media_id, i), 'url': 'http://link.theplatform.com/s/abc/pid'}],
+            }
+            for i in range(4)
+        ],
+        'thumbnails': [
+            {'url': 'http://example.com/thumb_%d_%d.jpg' % (media_id, i), 'width': 320, 'height': 180}
+            for i in range(3)
+        ],
+        'pl1$show': 'Show %d' % rng.randint(0, 20),
+        'pl1$season': rng.randint(1, 10),
+        'pl1$episode': rng.randint(1, 24),
+        'pl1$tags': ['tag%d' % rng.randint(0, 100) for _ in range(5)],
+    }
+
+
+def media_feed(count, start=1, total=None, seed=0):
+    rng = random.Random(seed)
+    entries = [media_entry(i, rng) for i in range(start, start + count)]
+    feed = {
+        '$xmlns': {'pl1': 'http://xml.example.com/'},
+        'startIndex': start,
+        'itemsPerPage': count,
+        'entryCount': len(entries),
+        'entries': entries,
+    }
+    if total is not None:
+        feed['totalResults'] = total
+    return feed
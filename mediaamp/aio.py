@@ -0,0 +1,431 @@
+""" asyncio support, requires the optional ``aiohttp`` dependency.
+
+    pip install mediaampy[async]
+
+"""
+import asyncio
+from base64 import b64encode
+import copy
+import time
+
+import aiohttp
+
+from .cache import request_key
+from .http import DEFAULT_HEADERS, Session, TokenRenewer, log
+from .metrics import RequestEvent
+from .streaming import FeedDecoder
+from .exceptions import (
+    CircuitOpenError,
+    InvalidTokenError,
+    AuthenticationError,
+    MediaAmpError,
+    http_error,
+    raise_for_json_exception,
+)
+
+
+class AsyncSession(Session):
+    """ A Session whose request methods are coroutines.
+
+    Requests are made with a pooled ``aiohttp.ClientSession`` that is created
+    on first use inside the running event loop. Services are looked up the
+    same way as on ``Session`` and their endpoint methods return awaitables:
+
+        async with AsyncSession(username, password, account_id) as session:
+            media_data = await session.service('Media Data Service')
+            media = await media_data.Media.get(params={'byTitle': 'Example'})
+
+    Because the registry can't be fetched synchronously, it has to be loaded
+    (``await session.load_registry()`` or ``await session.service(key)``)
+    before services can be obtained with ``session[key]``.
+
+    ``stream`` returns an async generator. The endpoint helpers built on
+    threads and synchronous iteration (``iter_all``, ``fetch_all``,
+    ``bulk_write`` and ``stream`` with ``records``) raise ``MediaAmpError``
+    on an async session.
+
+    """
+
+    transport_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+    is_async = True
+
+    def __init__(self, *args, **kwargs):
+        self.connector = kwargs.pop('connector', None)
+        super(AsyncSession, self).__init__(*args, **kwargs)
+        self._async_token_lock = None
+        self._async_in_flight = AsyncSingleFlight()
+
+    def create_http_session(self):
+        # aiohttp sessions must be created inside a running loop
+        return None
+
+    @property
+    def client(self):
+        if self.session is None or self.session.closed:
+            connect, read = _timeouts(self.pool.timeout)
+            self.session = aiohttp.ClientSession(
+                headers=DEFAULT_HEADERS,
+                connector=self.connector or self.create_connector(),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+            )
+        return self.session
+
+    def create_connector(self):
+        # aiohttp always waits for a free connection, ``block`` does not apply
+        return aiohttp.TCPConnector(
+            limit=self.pool.pools * self.pool.maxsize,
+            limit_per_host=self.pool.maxsize,
+            ssl=self.pool.ssl_context,
+        )
+
+    def pool_stats(self):
+        # aiohttp has no public API for this, read the connector's bookkeeping
+        stats = {}
+        connector = self.session.connector if self.session is not None else None
+        if connector is None:
+            return stats
+        idle = getattr(connector, '_conns', {})
+        acquired = getattr(connector, '_acquired_per_host', {})
+        for key in set(idle) | set(acquired):
+            origin = '%s://%s:%s' % ('https' if key.is_ssl else 'http', key.host, key.port)
+            stats[origin] = {
+                'maxsize': connector.limit_per_host,
+                'in_use': len(acquired.get(key, ())),
+                'idle': len(idle.get(key, ())),
+            }
+        return stats
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            raise MediaAmpError('Registry not loaded, await load_registry() first.')
+        return self._registry
+
+    async def load_registry(self):
+        if self._registry is None:
+            self._registry = self._load_stored_registry()
+        if self._registry is None:
+            self._registry = await self.resolve_domain()
+            self._save_registry()
+        return self._registry
+
+    async def service(self, key):
+        await self.load_registry()
+        return self[key]
+
+    async def resolve_domain(self):
+        resp = await self.get(self.registry_url, endpoint='resolveDomain', params={
+            'schema': '1.1',
+            '_accountId': self.account,
+        })
+        try:
+            return resp['resolveDomainResponse']
+        except KeyError:
+            raise MediaAmpError('Unexpected response loading registry.')
+
+    async def sign_in(self):
+        params = {
+            'schema': '1.0',
+            '_duration': self.token_duration,
+            '_idleTimeout': self.token_idle_timeout,
+        }
+        auth = basic_auth(self.signin_username, self.password)
+        result = await self.get(self.signin_url, is_signin_request=True, retry_sign_in=False,
+                                headers=auth, params=params, endpoint='signIn')
+        try:
+            self.auth_token = result['signInResponse']['token']
+        except KeyError:
+            raise AuthenticationError('Could not retrieve token.')
+        self.token_issued_at = self.token_last_used = time.time()
+        self.post_sign_in.send(self)
+
+    async def refresh_token(self, stale_token=None):
+        """ Coroutine equivalent of ``Session.refresh_token``. """
+        if self._async_token_lock is None:
+            self._async_token_lock = asyncio.Lock()
+        async with self._async_token_lock:
+            if self.auth_token is None or self.auth_token == stale_token:
+                started = time.time()
+                source = 'sign_in'
+                # the store lock would block the loop, so only adopt a fresher
+                # token saved by another process before signing in
+                if self.store is not None and self._load_stored_token(stale_token):
+                    source = 'store'
+                else:
+                    await self.sign_in()
+                self.token_refreshed.send(self, source=source, elapsed=time.time() - started)
+            return self.auth_token
+
+    async def request_json(self, method, url, retry_sign_in=True, is_signin_request=False,
+                           idempotent=None, service_key=None, use_cache=True, endpoint=None,
+                           replica_url=None, **kwargs):
+        """ Coroutine equivalent of ``Session.request_json``. """
+        if self.coalesce and method == 'get' and not is_signin_request:
+            key = request_key(url, kwargs.get('params'), self.account)
+            data, shared = await self._async_in_flight.do(
+                key, self._request, method, url, retry_sign_in, is_signin_request,
+                idempotent, service_key, use_cache, endpoint, replica_url, **kwargs
+            )
+            return copy.deepcopy(data) if shared else data
+        return await self._request(method, url, retry_sign_in, is_signin_request, idempotent,
+                                   service_key, use_cache, endpoint, replica_url, **kwargs)
+
+    async def _request(self, method, url, retry_sign_in, is_signin_request, idempotent,
+                       service_key, use_cache, endpoint, replica_url=None, **kwargs):
+        cache_key = cached = None
+        if self.cache is not None and use_cache and method == 'get' and not is_signin_request:
+            cache_key = self.cache.key(url, kwargs.get('params'), self.account)
+            cached, fresh = self.cache.lookup(cache_key)
+            if fresh:
+                return self.codec.loads(cached['body'])
+
+        args = (retry_sign_in, is_signin_request, idempotent, service_key, endpoint,
+                cache_key, cached)
+        if (replica_url is not None and method == 'get'
+                and self.routing.use_replica(service_key, replica_url)):
+            try:
+                data = await self._attempts(method, replica_url, *args, **kwargs)
+            except Exception as e:
+                if not self.routing.record(replica_url, e, self.transport_errors):
+                    raise
+            else:
+                self.routing.record(replica_url)
+                return data
+        data = await self._attempts(method, url, *args, **kwargs)
+        if replica_url is not None and method != 'get':
+            # pin reads to the primary only once the write went through
+            self.routing.wrote(service_key)
+            if self.cache is not None:
+                self.cache.invalidate(replica_url)
+        return data
+
+    async def _attempts(self, method, url, retry_sign_in, is_signin_request, idempotent,
+                        service_key, endpoint, cache_key, cached, **kwargs):
+        policy = self.retry
+        breaker = policy.breaker(url) if policy is not None else None
+        attempt = 1
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError('Too many failures, not calling %s.' % url)
+            event = RequestEvent(service_key, endpoint, method, url, attempt)
+            try:
+                data = await self._request_json(method, url, retry_sign_in, is_signin_request,
+                                                service_key, cache_key, cached, event, **kwargs)
+            except Exception as e:
+                if policy is None:
+                    raise
+                if breaker is not None:
+                    breaker.record(policy.is_failure(e, self.transport_errors))
+                if not policy.should_retry(method, e, attempt, idempotent, self.transport_errors):
+                    raise
+                delay = policy.delay(attempt, e)
+            else:
+                if breaker is not None:
+                    breaker.record(False)
+                if self.cache is not None and method in ('put', 'post', 'delete'):
+                    self.cache.invalidate(url)
+                return data
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _request_json(self, method, url, retry_sign_in, is_signin_request, service_key,
+                            cache_key=None, cached=None, event=None, **kwargs):
+        if event is None:
+            event = RequestEvent(service_key, None, method, url)
+        token = await self._authorize(is_signin_request, service_key, kwargs, event)
+        if cached is not None:
+            conditional = self.cache.conditional_headers(cached)
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **conditional)
+
+        try:
+            return await self._exchange(method, url, cache_key, cached, event, **kwargs)
+        except InvalidTokenError:
+            if retry_sign_in:
+                await self.refresh_token(token)
+                return await self._request_json(method, url, False, is_signin_request,
+                                                service_key, cache_key, cached, event.retry(),
+                                                **kwargs)
+            else:
+                raise
+
+    async def _exchange(self, method, url, cache_key, cached, event, **kwargs):
+        try:
+            if self.pre_request.receivers:
+                self.pre_request.send(self, event=event, request=kwargs)
+            started = time.time()
+            async with self.client.request(method.upper(), url, **kwargs) as response:
+                event.status = response.status
+                await _raise_for_status(response)
+                if cached is not None and response.status == 304:
+                    event.transfer = time.time() - started
+                    self.cache.revalidated(cache_key, cached)
+                    data = self.codec.loads(cached['body'])
+                    body = None
+                else:
+                    body = await response.read()
+                    event.transfer = time.time() - started
+                    event.response_bytes = len(body)
+            if body is not None:
+                started = time.time()
+                try:
+                    data = self.codec.loads(body)
+                except ValueError:
+                    raise MediaAmpError('Response body can not be read as JSON. ')
+                event.decode = time.time() - started
+                raise_for_json_exception(data)
+                if cache_key is not None:
+                    self.cache.save(cache_key, url, body.decode('utf-8'), response.headers)
+        except Exception as e:
+            self.request_failed.send(self, event=event.finish(e))
+            raise
+        self.post_request.send(self, event=event.finish())
+        return data
+
+    async def _authorize(self, is_signin_request, service_key, kwargs, event):
+        token = None
+        if not is_signin_request:
+            if self.token_renewal == 'background' and self._renewer is None:
+                self._renewer = asyncio.ensure_future(self._renew_token())
+            token = self.auth_token
+            if token is None or (self.token_renewal == 'lazy' and self.token_renewal_due()):
+                token = await self.refresh_token(token)
+            self.token_last_used = time.time()
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **basic_auth('', token))
+
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.reserve(self.account, service_key)
+            if delay:
+                event.throttle = delay
+                await asyncio.sleep(delay)
+
+        if 'params' in kwargs:
+            kwargs['params'] = _stringify_params(kwargs['params'])
+        if 'json' in kwargs:
+            kwargs['data'] = self.codec.dumps(kwargs.pop('json'))
+        if isinstance(kwargs.get('data'), bytes):
+            event.request_bytes = len(kwargs['data'])
+        return token
+
+    async def stream_json(self, method, url, retry_sign_in=True, service_key=None, header=None,
+                          chunk_size=65536, endpoint=None, replica_url=None, **kwargs):
+        """ Async generator equivalent of ``Session.stream_json``. """
+        if replica_url is not None and self.routing.use_replica(service_key, replica_url):
+            streamed = False
+            error = None
+            try:
+                async for entry in self.stream_json(method, replica_url, retry_sign_in,
+                                                    service_key, header, chunk_size, endpoint,
+                                                    **kwargs):
+                    streamed = True
+                    yield entry
+            except Exception as e:
+                error = e
+                if not self.routing.record(replica_url, e, self.transport_errors) or streamed:
+                    raise
+            finally:
+                if error is None:
+                    self.routing.record(replica_url)
+            if error is None:
+                return
+        event = RequestEvent(service_key, endpoint, method, url)
+        token = await self._authorize(False, service_key, kwargs, event)
+        decoder = FeedDecoder(header)
+        try:
+            if self.pre_request.receivers:
+                self.pre_request.send(self, event=event, request=kwargs)
+            async with self.client.request(method.upper(), url, **kwargs) as response:
+                event.status = response.status
+                await _raise_for_status(response)
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    event.response_bytes += len(chunk)
+                    for entry in decoder.feed(chunk):
+                        yield entry
+                for entry in decoder.close():
+                    yield entry
+        except Exception as e:
+            self.request_failed.send(self, event=event.finish(e))
+            if not isinstance(e, InvalidTokenError) or decoder.streamed or not retry_sign_in:
+                raise
+            await self.refresh_token(token)
+            retried = self.stream_json(method, url, False, service_key, header, chunk_size,
+                                       endpoint, **kwargs)
+            async for entry in retried:
+                yield entry
+        else:
+            self.post_request.send(self, event=event.finish())
+
+    def start_token_renewal(self):
+        # the renewal task is started by the first request, inside the loop
+        pass
+
+    async def _renew_token(self):
+        while True:
+            expires_at = self.token_expires_at
+            if expires_at is None:
+                delay = TokenRenewer.retry_interval
+            else:
+                delay = expires_at - self.token_renewal_margin / 1000.0 - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await self.refresh_token(self.auth_token)
+            except Exception:
+                log.exception('Unable to renew token, retrying in %ss.', TokenRenewer.retry_interval)
+                await asyncio.sleep(TokenRenewer.retry_interval)
+
+    async def close(self):
+        if self._renewer is not None:
+            self._renewer.cancel()
+            self._renewer = None
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncSingleFlight(object):
+    """ Coroutine equivalent of ``mediaamp.concurrency.SingleFlight``. """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is not None:
+            return await asyncio.shield(call), True
+        call = asyncio.ensure_future(fn(*args, **kwargs))
+        self._calls[key] = call
+        call.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(call), False
+
+
+async def _raise_for_status(response):
+    if response.status >= 400:
+        text = await response.text()
+        raise http_error(response.status, text, response.headers.get('Retry-After'))
+
+
+def basic_auth(username, password):
+    credentials = ('%s:%s' % (username, password)).encode('utf-8')
+    return {'Authorization': 'Basic ' + b64encode(credentials).decode('ascii')}
+
+
+def _timeouts(timeout):
+    if isinstance(timeout, tuple):
+        return timeout
+    return timeout, timeout
+
+
+def _stringify_params(params):
+    # aiohttp rejects booleans and other non-string query values
+    stringified = {}
+    for k, v in params.items():
+        if isinstance(v, bool):
+            v = 'true' if v else 'false'
+        stringified[k] = v if isinstance(v, str) else str(v)
+    return stringified
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+import threading
+import time
+
+try:
+    from urllib.parse import urlencode
+except ImportError:  # Python 2
+    from urllib import urlencode
+
+
+class ResponseCache(object):
+    """ LRU cache of GET response bodies with a TTL.
+
+    Up to ``maxsize`` responses are kept in memory for ``ttl`` seconds. Once
+    expired, a response that came with an ``ETag`` or ``Last-Modified``
+    header is revalidated with a conditional request instead of being
+    fetched again. A ``store`` (see ``mediaamp.store``) can be supplied to
+    persist responses, e.g. a ``FileStore`` to share them between processes.
+    Stored responses expire from the store after ``ttl`` seconds. Entries
+    loaded from it are checked against the writes this cache has seen in
+    the last ``ttl`` seconds, but writes made by other processes are only
+    picked up once the TTL expires.
+
+    A successful PUT, POST or DELETE invalidates cached responses for the
+    same object, for objects below it (e.g. a feed update of ``/data/Media``
+    drops every cached Media object) and for the collection containing it.
+
+    Counters are available from ``stats``.
+
+    """
+
+    namespace = 'response-cache'
+
+    def __init__(self, maxsize=1024, ttl=300, store=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # recent writes by URL (and by URL of the collections above them),
+        # to invalidate responses that are only in the store
+        self._written = OrderedDict()
+        self._below = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, url, params, account):
+        return request_key(url, params, account)
+
+    def lookup(self, key):
+        """ Return the cached entry for ``key`` (or None) and whether it is fresh. """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(self.namespace, key)
+            if entry is not None and self._invalidated(entry):
+                self.store.delete(self.namespace, key)
+                entry = None
+            if entry is not None:
+                self._add(key, entry)
+        fresh = entry is not None and entry['expires_at'] > now
+        if entry is not None and not fresh and not (entry['etag'] or entry['last_modified']):
+            self._discard(key)
+            entry = None
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry, fresh
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def save(self, key, url, body, headers):
+        if 'no-store' in headers.get('Cache-Control', ''):
+            return
+        now = time.time()
+        entry = {
+            'url': url.split('?', 1)[0],
+            'body': body,
+            'stored_at': now,
+            'expires_at': now + self.ttl,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        self._add(key, entry)
+        if self.store is not None:
+            self.store.set(self.namespace, key, entry, expires_at=entry['expires_at'])
+
+    def revalidated(self, key, entry):
+        """ Mark a stale ``entry`` fresh after a 304 Not Modified response. """
+        now = time.time()
+        entry = dict(entry, stored_at=now, expires_at=now + self.ttl)
+        self._add(key, entry)
+        if self.store is not None:
+            self.store.set(self.namespace, key, entry, expires_at=entry['expires_at'])
+        with self._lock:
+            self.revalidations += 1
+
+    def invalidate(self, url):
+        url = url.split('?', 1)[0].rstrip('/')
+        now = time.time()
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if _related(entry['url'], url)]
+            if self.store is not None:
+                self._log(self._written, url, now)
+                for parent in _ancestors(url):
+                    self._log(self._below, parent, now)
+        for key in keys:
+            self._discard(key)
+        with self._lock:
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+        for key in keys:
+            self._discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+    def _add(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _log(self, log, url, now):
+        # writes older than the TTL can't affect anything left in the store
+        log.pop(url, None)
+        log[url] = now
+        while next(iter(log.values())) < now - self.ttl:
+            log.popitem(last=False)
+
+    def _invalidated(self, entry):
+        # whether a write seen since ``entry`` was stored affects it
+        url = entry['url'].rstrip('/')
+        stored_at = entry.get('stored_at', 0)
+        with self._lock:
+            times = [self._written.get(url), self._below.get(url)]
+            times.extend(self._written.get(parent) for parent in _ancestors(url))
+        return any(t is not None and t >= stored_at for t in times)
+
+    def _discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.store is not None:
+            self.store.delete(self.namespace, key)
+
+
+def request_key(url, params, account):
+    """ Identify a GET by account, URL and query parameters. """
+    query = urlencode(sorted((params or {}).items()))
+    return '%s|%s?%s' % (account, url, query)
+
+
+def _ancestors(url):
+    """ The URLs above ``url``, e.g. its collection, up to the host. """
+    parents = []
+    while True:
+        url, sep, _ = url.rpartition('/')
+        if not sep or url.endswith('/') or url.endswith(':'):
+            return parents
+        parents.append(url)
+
+
+def _related(cached_url, written_url):
+    cached_url = cached_url.rstrip('/')
+    return (
+        cached_url == written_url
+        or cached_url.startswith(written_url + '/')
+        or written_url.startswith(cached_url + '/')
+    )
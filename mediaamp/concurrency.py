@@ -0,0 +1,99 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+import threading
+
+_exhausted = object()
+
+
+def prefetch(iterable):
+    """ Advance ``iterable`` one item ahead on a background thread.
+
+    While the caller consumes an item the next one is being produced, so at
+    most two items are held in memory at any time.
+
+    """
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, _exhausted)
+        while True:
+            item = future.result()
+            if item is _exhausted:
+                return
+            future = executor.submit(next, iterator, _exhausted)
+            yield item
+
+
+def bounded_map(fn, iterable, workers=4, max_in_flight=None, ordered=True):
+    """ Call ``fn`` for each item of ``iterable`` on a pool of threads.
+
+    No more than ``max_in_flight`` calls (default: ``workers``) are submitted
+    at once and the input is consumed lazily. Results are yielded in input
+    order, or as soon as they complete when ``ordered`` is false. The first
+    exception raised by ``fn`` is propagated and outstanding calls are
+    cancelled.
+
+    """
+    max_in_flight = max(max_in_flight or workers, 1)
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(fn, item) for item in islice(iterator, max_in_flight))
+        try:
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    pending = deque(not_done)
+                for future in done:
+                    result = future.result()
+                    for item in islice(iterator, 1):
+                        pending.append(executor.submit(fn, item))
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class SingleFlight(object):
+    """ Collapses concurrent calls made with the same key into one.
+
+    The first caller for a key runs the function; callers arriving while it
+    is in flight wait for it and receive the same result, or exception.
+    ``do`` returns the result and whether it came from another caller's call.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -4,11 +4,18 @@ from collections import defaultdict
 class MediaAmpError(Exception):
     """Unspecified error occurred."""
 
+    status_code = None
+    retry_after = None
+
 
 class ClientError(MediaAmpError):
     """Bad request or unauthorized request."""
 
 
+class TooManyRequests(ClientError):
+    """Request was throttled by the remote service."""
+
+
 class NotFound(MediaAmpError):
     """Requested resource not found."""
 
@@ -29,10 +36,28 @@ class ServiceNotAvailable(MediaAmpError):
     """Could not find service by name in the registry."""
 
 
+class CircuitOpenError(MediaAmpError):
+    """Service has been failing and requests to it are rejected for now."""
+
+
+class JobFailed(MediaAmpError):
+    """A watched task or publish ended in a failed state."""
+
+    def __init__(self, message, entry=None):
+        super(JobFailed, self).__init__(message)
+        self.entry = entry
+
+
+def http_error(status_code, text, retry_after=None):
+    exc = http_status_map[status_code](text)
+    exc.status_code = status_code
+    exc.retry_after = retry_after
+    return exc
+
+
 def wrap_http_error(error):
     response = error.response
-    error_class = http_status_map[response.status_code]
-    raise error_class(response.text)
+    raise http_error(response.status_code, response.text, response.headers.get('Retry-After'))
 
 
 http_status_map = defaultdict(lambda: MediaAmpError)
@@ -41,6 +66,7 @@ for code in range(400, 500):
 for code in (401, 403):
     http_status_map[code] = AuthenticationError
 http_status_map[404] = NotFound
+http_status_map[429] = TooManyRequests
 for code in range(500, 600):
     http_status_map[code] = ServerError
 
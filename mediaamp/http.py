@@ -1,13 +1,25 @@
 from blinker import Signal
+import copy
+import logging
 import requests
 from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from requests.packages.urllib3.poolmanager import PoolManager
 import ssl
+import threading
+import time
 
 from . import __version__, __title__
+from .cache import request_key
+from .concurrency import SingleFlight
+from .jsoncodec import get_codec
+from .metrics import RequestEvent
+from .pool import PooledAdapter, PoolConfig
+from .registry import ServiceIndex
 from .services import services
+from .streaming import iter_entries
 from .exceptions import (
+    CircuitOpenError,
     InvalidTokenError,
     AuthenticationError,
     MediaAmpError,
@@ -16,12 +28,23 @@ from .exceptions import (
 )
 
 
+log = logging.getLogger(__name__)
+
 SIGN_IN_URL = 'https://identity.auth.theplatform.{tld}/idm/web/Authentication/signIn'
 REGISTRY_URL = 'https://access.auth.theplatform.{tld}/web/Registry/resolveDomain'
+DEFAULT_HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept': 'application/json',
+    'User-Agent': 'Python Mediaamp %s' % __version__,
+}
 
 
 class Session(object):
 
+    registry_ttl = 86400    # seconds a stored registry is reused
+    transport_errors = (requests.ConnectionError, requests.Timeout)
+    is_async = False
+
     def __init__(self,
                  username,
                  password,
@@ -33,6 +56,16 @@ class Session(object):
                  token_duration=43200000,       # 12 hours
                  token_idle_timeout=14400000,   # 4 hours
                  use_ssl=True,
+                 token_renewal=None,
+                 token_renewal_margin=300000,   # 5 minutes
+                 store=None,
+                 retry=None,
+                 rate_limiter=None,
+                 codec=None,
+                 cache=None,
+                 coalesce=False,
+                 pool=None,
+                 routing=None,
                  ):
 
         self.username = username
@@ -44,24 +77,130 @@ class Session(object):
         self.token_duration = token_duration
         self.token_idle_timeout = token_idle_timeout
         self.use_ssl = use_ssl
+        self.token_renewal = token_renewal
+        self.token_renewal_margin = token_renewal_margin
+        self.token_issued_at = None
+        self.token_last_used = None
+        self.store = store
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.codec = get_codec(codec)
+        self.cache = cache
+        self.coalesce = coalesce
+        self.pool = pool or PoolConfig()
+        self.routing = routing
+        self._in_flight = SingleFlight()
         self.registry_url = REGISTRY_URL.format(tld=self.regional_tld)
         self.signin_url = SIGN_IN_URL.format(tld=self.regional_tld)
         self.post_sign_in = Signal()
+        self.pre_request = Signal()
+        self.post_request = Signal()
+        self.request_failed = Signal()
+        self.token_refreshed = Signal()
         self._registry = service_registry
-        self.session = requests.Session()
-        self.session.mount('https://', TLS1Adapter())
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'User-Agent': 'Python Mediaamp %s' % __version__,
-        })
+        self._registry_lock = threading.Lock()
+        self._service_index = None
+        self._services = {}
+        self._token_lock = threading.Lock()
+        self.session = self.create_http_session()
+        if store is not None:
+            self.post_sign_in.connect(self._save_token, sender=self)
+            if auth_token is None:
+                self._load_stored_token()
+        self._renewer = None
+        if token_renewal == 'background':
+            self.start_token_renewal()
+
+    def create_http_session(self):
+        session = requests.Session()
+        adapter = PooledAdapter(self.pool)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(DEFAULT_HEADERS)
+        return session
+
+    def pool_stats(self):
+        """ Connection pool utilization per host, see ``PooledAdapter.stats``. """
+        stats = {}
+        for adapter in set(self.session.adapters.values()):
+            if isinstance(adapter, PooledAdapter):
+                stats.update(adapter.stats())
+        return stats
 
     @property
     def registry(self):
         if self._registry is None:
-            self._registry = self.resolve_domain()
+            with self._registry_lock:
+                if self._registry is None:
+                    self._registry = self._load_stored_registry()
+                if self._registry is None:
+                    self._registry = self.resolve_domain()
+                    self._save_registry()
         return self._registry
 
+    @property
+    def token_store_key(self):
+        return '%s|%s' % (self.signin_username, self.region)
+
+    @property
+    def registry_store_key(self):
+        return '%s|%s' % (self.account, self.region)
+
+    def _load_stored_token(self, stale_token=None):
+        record = self.store.get('token', self.token_store_key)
+        if not record or record['token'] == stale_token:
+            return False
+        self.auth_token = record['token']
+        self.token_issued_at = record['issued_at']
+        self.token_last_used = time.time()
+        return True
+
+    def _save_token(self, session):
+        record = {'token': self.auth_token, 'issued_at': self.token_issued_at}
+        self.store.set('token', self.token_store_key, record, expires_at=self.token_expires_at)
+
+    def _load_stored_registry(self):
+        if self.store is not None:
+            return self.store.get('registry', self.registry_store_key)
+
+    def _save_registry(self):
+        if self.store is not None:
+            expires_at = time.time() + self.registry_ttl
+            self.store.set('registry', self.registry_store_key, self._registry, expires_at=expires_at)
+
+    @property
+    def token_expires_at(self):
+        """ Epoch seconds at which the current token expires, if known.
+
+        The earlier of the token duration and the idle timeout, based on when
+        the token was issued and last used by this session.
+
+        """
+        if self.token_issued_at is None:
+            return None
+        return min(
+            self.token_issued_at + self.token_duration / 1000.0,
+            self.token_last_used + self.token_idle_timeout / 1000.0,
+        )
+
+    def token_renewal_due(self):
+        expires_at = self.token_expires_at
+        if expires_at is None:
+            return False
+        return time.time() >= expires_at - self.token_renewal_margin / 1000.0
+
+    def start_token_renewal(self):
+        """ Renew the token on a background thread before it expires. """
+        if self._renewer is None:
+            self._renewer = TokenRenewer(self)
+            self._renewer.start()
+
+    def close(self):
+        if self._renewer is not None:
+            self._renewer.stop()
+            self._renewer = None
+        self.session.close()
+
     @property
     def regional_tld(self):
         return 'eu' if 'eu' in self.region.lower() else 'com'
@@ -71,7 +210,7 @@ class Session(object):
         return self.user_directory + '/' + self.username
 
     def resolve_domain(self):
-        resp = self.get(self.registry_url, params={
+        resp = self.get(self.registry_url, endpoint='resolveDomain', params={
             'schema': '1.1',
             '_accountId': self.account,
         })
@@ -81,20 +220,48 @@ class Session(object):
             raise MediaAmpError('Unexpected response loading registry.')
 
     def sign_in(self):
-        self.auth_token = None
-        self.session.auth = HTTPBasicAuth(self.signin_username, self.password)
-        result = self.get(self.signin_url, is_signin_request=True, params={
+        params = {
             'schema': '1.0',
             '_duration': self.token_duration,
             '_idleTimeout': self.token_idle_timeout,
-        })
+        }
+        auth = HTTPBasicAuth(self.signin_username, self.password)
+        result = self.get(self.signin_url, is_signin_request=True, retry_sign_in=False,
+                          auth=auth, params=params, endpoint='signIn')
         try:
             self.auth_token = result['signInResponse']['token']
         except KeyError:
             raise AuthenticationError('Could not retrieve token.')
+        self.token_issued_at = self.token_last_used = time.time()
         self.post_sign_in.send(self)
 
-    def request_json(self, method, url, retry_sign_in=True, is_signin_request=False, **kwargs):
+    def refresh_token(self, stale_token=None):
+        """ Sign in unless another thread has already replaced ``stale_token``.
+
+        Only one thread signs in at a time; threads that were waiting on it
+        reuse the token it obtained instead of signing in again. With a
+        ``store`` the same applies across processes: a fresher token saved by
+        another process is adopted instead of signing in.
+
+        """
+        with self._token_lock:
+            if self.auth_token is None or self.auth_token == stale_token:
+                started = time.time()
+                source = 'sign_in'
+                if self.store is None:
+                    self.sign_in()
+                else:
+                    with self.store.lock('token', self.token_store_key):
+                        if self._load_stored_token(stale_token):
+                            source = 'store'
+                        else:
+                            self.sign_in()
+                self.token_refreshed.send(self, source=source, elapsed=time.time() - started)
+            return self.auth_token
+
+    def request_json(self, method, url, retry_sign_in=True, is_signin_request=False,
+                     idempotent=None, service_key=None, use_cache=True, endpoint=None,
+                     replica_url=None, **kwargs):
         """ Requests JSON content from the supplied URL.
 
         This is the primary function to be used to make requests to the MPX API.
@@ -107,35 +274,232 @@ class Session(object):
         the JSON returned. This checks for that case and turns them into actual
         exceptions.
 
-        """
-        if self.auth_token is not None:
-            self.session.auth = HTTPBasicAuth('', self.auth_token)
-        elif not is_signin_request:
-            self.sign_in()
+        Transient failures are retried according to the session's ``retry``
+        policy. Writes are only retried when ``idempotent`` is true. Requests
+        are throttled by the session's ``rate_limiter``, using ``service_key``
+        (the registry key of the service being called) to pick the limit.
 
-        response = getattr(self.session, method)(url, **kwargs)
+        GETs are answered from the session's ``cache``, if any, unless
+        ``use_cache`` is false; writes invalidate the cached responses they
+        affect. With ``coalesce`` enabled, identical GETs made concurrently
+        share a single request.
 
-        try:
-            response.raise_for_status()
-        except requests.HTTPError as e:
-            wrap_http_error(e)
+        Every HTTP exchange is reported to the ``pre_request``,
+        ``post_request`` and ``request_failed`` signals with a
+        ``RequestEvent`` (see ``mediaamp.metrics``) labelled with
+        ``service_key`` and ``endpoint``.
 
-        try:
-            data = response.json()
-        except ValueError:
-            raise MediaAmpError('Response body can not be read as JSON. ')
+        ``replica_url`` is the same resource on a read-only host (see
+        ``mediaamp.routing``). GETs are sent there and fall back to ``url``
+        when the read-only host fails; writes also invalidate the responses
+        cached from it.
+
+        """
+        if self.coalesce and method == 'get' and not is_signin_request:
+            key = request_key(url, kwargs.get('params'), self.account)
+            data, shared = self._in_flight.do(
+                key, self._request, method, url, retry_sign_in, is_signin_request,
+                idempotent, service_key, use_cache, endpoint, replica_url, **kwargs
+            )
+            return copy.deepcopy(data) if shared else data
+        return self._request(method, url, retry_sign_in, is_signin_request, idempotent,
+                             service_key, use_cache, endpoint, replica_url, **kwargs)
+
+    def _request(self, method, url, retry_sign_in, is_signin_request, idempotent, service_key,
+                 use_cache, endpoint, replica_url=None, **kwargs):
+        cache_key = cached = None
+        if self.cache is not None and use_cache and method == 'get' and not is_signin_request:
+            cache_key = self.cache.key(url, kwargs.get('params'), self.account)
+            cached, fresh = self.cache.lookup(cache_key)
+            if fresh:
+                return self.codec.loads(cached['body'])
+
+        args = (retry_sign_in, is_signin_request, idempotent, service_key, endpoint,
+                cache_key, cached)
+        if (replica_url is not None and method == 'get'
+                and self.routing.use_replica(service_key, replica_url)):
+            try:
+                data = self._attempts(method, replica_url, *args, **kwargs)
+            except Exception as e:
+                if not self.routing.record(replica_url, e, self.transport_errors):
+                    raise
+            else:
+                self.routing.record(replica_url)
+                return data
+        data = self._attempts(method, url, *args, **kwargs)
+        if replica_url is not None and method != 'get':
+            # pin reads to the primary only once the write went through
+            self.routing.wrote(service_key)
+            if self.cache is not None:
+                self.cache.invalidate(replica_url)
+        return data
+
+    def _attempts(self, method, url, retry_sign_in, is_signin_request, idempotent, service_key,
+                  endpoint, cache_key, cached, **kwargs):
+        policy = self.retry
+        breaker = policy.breaker(url) if policy is not None else None
+        attempt = 1
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError('Too many failures, not calling %s.' % url)
+            event = RequestEvent(service_key, endpoint, method, url, attempt)
+            try:
+                data = self._request_json(method, url, retry_sign_in, is_signin_request,
+                                          service_key, cache_key, cached, event, **kwargs)
+            except Exception as e:
+                if policy is None:
+                    raise
+                if breaker is not None:
+                    breaker.record(policy.is_failure(e, self.transport_errors))
+                if not policy.should_retry(method, e, attempt, idempotent, self.transport_errors):
+                    raise
+                delay = policy.delay(attempt, e)
+            else:
+                if breaker is not None:
+                    breaker.record(False)
+                if self.cache is not None and method in ('put', 'post', 'delete'):
+                    self.cache.invalidate(url)
+                return data
+            time.sleep(delay)
+            attempt += 1
+
+    def _request_json(self, method, url, retry_sign_in, is_signin_request, service_key,
+                      cache_key=None, cached=None, event=None, **kwargs):
+        if event is None:
+            event = RequestEvent(service_key, None, method, url)
+        token = self._authorize(is_signin_request, kwargs)
+        if cached is not None:
+            conditional = self.cache.conditional_headers(cached)
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **conditional)
 
         try:
-            raise_for_json_exception(data)
+            return self._exchange(method, url, service_key, cache_key, cached, event, **kwargs)
         except InvalidTokenError:
             if retry_sign_in:
-                self.sign_in()
-                return self.request_json(method, url, retry_sign_in=False, **kwargs)
+                self.refresh_token(token)
+                return self._request_json(method, url, False, is_signin_request, service_key,
+                                          cache_key, cached, event.retry(), **kwargs)
             else:
                 raise
 
+    def _exchange(self, method, url, service_key, cache_key, cached, event, **kwargs):
+        try:
+            response = self._send(method, url, service_key, event, **kwargs)
+            if cached is not None and response.status_code == 304:
+                self.cache.revalidated(cache_key, cached)
+                data = self.codec.loads(cached['body'])
+            else:
+                started = time.time()
+                try:
+                    data = self.codec.loads(response.content)
+                except ValueError:
+                    raise MediaAmpError('Response body can not be read as JSON. ')
+                event.decode = time.time() - started
+                raise_for_json_exception(data)
+                if cache_key is not None:
+                    self.cache.save(cache_key, url, response.content.decode('utf-8'),
+                                    response.headers)
+        except Exception as e:
+            self.request_failed.send(self, event=event.finish(e))
+            raise
+        self.post_request.send(self, event=event.finish())
         return data
 
+    def _authorize(self, is_signin_request, kwargs):
+        token = None
+        if not is_signin_request:
+            token = self.auth_token
+            if token is None or (self.token_renewal == 'lazy' and self.token_renewal_due()):
+                token = self.refresh_token(token)
+            self.token_last_used = time.time()
+            kwargs['auth'] = HTTPBasicAuth('', token)
+        return token
+
+    def _send(self, method, url, service_key, event, **kwargs):
+        if self.rate_limiter is not None:
+            started = time.time()
+            self.rate_limiter.acquire(self.account, service_key)
+            event.throttle = time.time() - started
+
+        if 'json' in kwargs:
+            kwargs['data'] = self.codec.dumps(kwargs.pop('json'))
+        if isinstance(kwargs.get('data'), bytes):
+            event.request_bytes = len(kwargs['data'])
+
+        if self.pre_request.receivers:
+            self.pre_request.send(self, event=event, request=kwargs)
+        started = time.time()
+        try:
+            response = getattr(self.session, method)(url, **kwargs)
+        finally:
+            event.transfer = time.time() - started
+        event.status = response.status_code
+        if not kwargs.get('stream'):
+            event.response_bytes = len(response.content)
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            wrap_http_error(e)
+        return response
+
+    def stream_json(self, method, url, retry_sign_in=True, service_key=None, header=None,
+                    chunk_size=65536, endpoint=None, replica_url=None, **kwargs):
+        """ Yield the entries of a JSON feed as they are read from the response.
+
+        Unlike ``request_json`` the body is never loaded as a whole; entries
+        are decoded from the response stream one at a time. The remaining
+        members of the feed are stored in the ``header`` dict, if supplied,
+        once the response has been read. MPX exception responses are raised
+        the same way as by ``request_json``.
+
+        A ``replica_url`` is used as by ``request_json``, except that the
+        stream only falls back to ``url`` if no entry has been yielded yet.
+
+        """
+        if replica_url is not None and self.routing.use_replica(service_key, replica_url):
+            streamed = False
+            error = None
+            try:
+                for entry in self.stream_json(method, replica_url, retry_sign_in, service_key,
+                                              header, chunk_size, endpoint, **kwargs):
+                    streamed = True
+                    yield entry
+            except Exception as e:
+                error = e
+                if not self.routing.record(replica_url, e, self.transport_errors) or streamed:
+                    raise
+            finally:
+                if error is None:
+                    self.routing.record(replica_url)
+            if error is None:
+                return
+        token = self._authorize(False, kwargs)
+        event = RequestEvent(service_key, endpoint, method, url)
+        try:
+            response = self._send(method, url, service_key, event, stream=True, **kwargs)
+        except Exception as e:
+            self.request_failed.send(self, event=event.finish(e))
+            raise
+        streamed = False
+        try:
+            for entry in iter_entries(_counted(response.iter_content(chunk_size), event), header):
+                streamed = True
+                yield entry
+        except Exception as e:
+            self.request_failed.send(self, event=event.finish(e))
+            if not isinstance(e, InvalidTokenError) or streamed or not retry_sign_in:
+                raise
+            self.refresh_token(token)
+            retried = self.stream_json(method, url, False, service_key, header, chunk_size,
+                                       endpoint, **kwargs)
+            for entry in retried:
+                yield entry
+        else:
+            self.post_request.send(self, event=event.finish())
+        finally:
+            response.close()
+
     def get(self, url, **kwargs):
         return self.request_json('get', url, **kwargs)
 
@@ -149,19 +513,90 @@ class Session(object):
         return self.request_json('delete', url, **kwargs)
 
     def __getitem__(self, key):
-        url = self.registry.get(key)
-        if url is None:
-            url = self.registry(key + ' read-only')
-        if url is None:
+        try:
+            return self._services[key]
+        except KeyError:
+            pass
+        hosts = self.service_index.hosts(key)
+        cls = services.get(key) or services.get(hosts.service)
+        if cls is None:
             raise KeyError(key + ' not available.')
-        if self.use_ssl:
-            url = url.replace('http://', 'https://')
-        return services[key](self, url)
+        return self._services.setdefault(key, cls(self, hosts.primary, hosts.read_only))
+
+    @property
+    def service_index(self):
+        """ The ``ServiceIndex`` of the registry, built on first use. """
+        registry = self.registry
+        index = self._service_index
+        if index is None or index.registry is not registry:
+            index = self._service_index = ServiceIndex(registry, use_ssl=self.use_ssl)
+        return index
+
+    def service_url(self, key, read_only=False):
+        return self.service_index.url(key, read_only)
+
+
+def _counted(chunks, event):
+    for chunk in chunks:
+        event.response_bytes += len(chunk)
+        yield chunk
+
+
+class TokenRenewer(threading.Thread):
+    """ Signs a session in again shortly before its token expires.
+
+    The renewal happens ``token_renewal_margin`` milliseconds ahead of the
+    deadline so requests never have to wait on a sign-in. Until the session
+    has signed in once there is no deadline and the thread sleeps.
+
+    """
+
+    retry_interval = 30
+
+    def __init__(self, session):
+        super(TokenRenewer, self).__init__(name='mediaamp-token-renewer')
+        self.daemon = True
+        self.session = session
+        self.stopped = False
+        self.wakeup = threading.Event()
+        session.post_sign_in.connect(self._signed_in, sender=session, weak=False)
+
+    def _signed_in(self, session):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.session.post_sign_in.disconnect(self._signed_in)
+        self.wakeup.set()
+
+    def run(self):
+        session = self.session
+        while not self.stopped:
+            expires_at = session.token_expires_at
+            timeout = None
+            if expires_at is not None:
+                renew_at = expires_at - session.token_renewal_margin / 1000.0
+                timeout = max(renew_at - time.time(), 0)
+            if self.wakeup.wait(timeout):
+                self.wakeup.clear()
+                continue
+            if not session.token_renewal_due():
+                # requests made meanwhile moved the idle deadline
+                continue
+            try:
+                session.refresh_token(session.auth_token)
+            except Exception:
+                log.exception('Unable to renew token, retrying in %ss.', self.retry_interval)
+                self.wakeup.wait(self.retry_interval)
+                self.wakeup.clear()
 
 
 class TLS1Adapter(HTTPAdapter):
     """ Force requests SSL to use TLS 1.
 
+    No longer mounted by ``Session``, which negotiates TLS 1.2 or newer
+    (see ``PoolConfig``); kept for code that mounts it explicitly.
+
     As of 4/30/2015 thePlatform APIs use TLS 1.2 which causes EOF
     errors with the default adapter. They are planning to update to
     SHA-256 certs @ June 15. see:
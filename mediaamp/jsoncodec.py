@@ -0,0 +1,78 @@
+""" Interchangeable JSON implementations for encoding and decoding bodies.
+
+The fastest installed library is used by default: orjson, then ujson,
+falling back to the standard library. Run ``benchmarks/bench_codecs.py`` to
+compare them on MPX sized payloads.
+
+"""
+import json
+
+
+class JSONCodec(object):
+    """ Standard library ``json``. """
+
+    name = 'json'
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonCodec(JSONCodec):
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+class UjsonCodec(JSONCodec):
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+codecs = (OrjsonCodec, UjsonCodec, JSONCodec)
+
+
+def available_codecs():
+    """ Instances of every codec whose library is installed. """
+    available = []
+    for codec in codecs:
+        try:
+            available.append(codec())
+        except ImportError:
+            pass
+    return available
+
+
+def get_codec(codec=None):
+    """ Resolve ``codec`` to a codec instance.
+
+    ``codec`` may be a codec instance, the name of one (``'orjson'``,
+    ``'ujson'`` or ``'json'``) or ``None`` for the fastest available.
+
+    """
+    if codec is None:
+        return available_codecs()[0]
+    if isinstance(codec, JSONCodec):
+        return codec
+    for cls in codecs:
+        if cls.name == codec:
+            return cls()
+    raise ValueError('Unknown JSON codec %r.' % codec)
@@ -0,0 +1,213 @@
+""" Request events and an in-memory aggregator for them.
+
+Every HTTP exchange made by a ``Session`` is described by a ``RequestEvent``
+sent with the session's ``pre_request`` signal before the request goes out,
+and with ``post_request`` or ``request_failed`` once it completed. Sign-ins
+and tokens adopted from a store are announced by ``token_refreshed``.
+``MetricsCollector`` subscribes to these signals and keeps per endpoint
+counters and latency percentiles:
+
+    metrics = MetricsCollector().attach(session)
+    ...
+    metrics.summary()
+    print(metrics.prometheus())
+
+"""
+from collections import deque
+import math
+import threading
+import time
+
+
+class RequestEvent(object):
+    """ A single HTTP exchange.
+
+    ``throttle`` is the time spent waiting for the rate limiter,
+    ``transfer`` the time taken to send the request and read the response
+    and ``decode`` the time spent decoding JSON, all in seconds.
+    ``duration`` covers the whole exchange and is set once it completed.
+
+    """
+
+    __slots__ = (
+        'service_key', 'endpoint', 'method', 'url', 'attempt', 'token_retry', 'status',
+        'request_bytes', 'response_bytes', 'started_at', 'throttle', 'transfer', 'decode',
+        'duration', 'error',
+    )
+
+    def __init__(self, service_key, endpoint, method, url, attempt=1, token_retry=False):
+        self.service_key = service_key
+        self.endpoint = endpoint
+        self.method = method
+        self.url = url
+        self.attempt = attempt
+        self.token_retry = token_retry
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.started_at = time.time()
+        self.throttle = 0.0
+        self.transfer = 0.0
+        self.decode = 0.0
+        self.duration = None
+        self.error = None
+
+    @property
+    def timings(self):
+        return {
+            'throttle': self.throttle,
+            'transfer': self.transfer,
+            'decode': self.decode,
+            'total': self.duration,
+        }
+
+    def retry(self):
+        """ The event for resending this request with a new token. """
+        return RequestEvent(self.service_key, self.endpoint, self.method, self.url,
+                            self.attempt, token_retry=True)
+
+    def finish(self, error=None):
+        self.duration = time.time() - self.started_at
+        self.error = error
+        return self
+
+    def __repr__(self):
+        return '<RequestEvent %s %s %s %.3fs>' % (
+            self.method.upper(), self.url, self.status, self.duration or 0
+        )
+
+
+class MetricsCollector(object):
+    """ Aggregates the request events of one or more sessions.
+
+    Latency percentiles are computed over the last ``window`` requests of
+    each (service, endpoint, method); counters cover the collector's whole
+    lifetime. ``samples`` lists every value as ``(name, labels, value)``,
+    which maps directly onto Prometheus samples or StatsD gauges, and
+    ``prometheus`` renders them in the Prometheus text format.
+
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.token_refreshes = {}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def attach(self, session):
+        session.post_request.connect(self.record, sender=session, weak=False)
+        session.request_failed.connect(self.record, sender=session, weak=False)
+        session.token_refreshed.connect(self._token_refreshed, sender=session, weak=False)
+        return self
+
+    def detach(self, session):
+        session.post_request.disconnect(self.record)
+        session.request_failed.disconnect(self.record)
+        session.token_refreshed.disconnect(self._token_refreshed)
+
+    def record(self, sender, event, **kwargs):
+        key = (event.service_key or '', event.endpoint or '', event.method)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self.window)
+            series.add(event)
+
+    def _token_refreshed(self, sender, source, **kwargs):
+        with self._lock:
+            self.token_refreshes[source] = self.token_refreshes.get(source, 0) + 1
+
+    def summary(self):
+        """ Counters and latency percentiles keyed by (service, endpoint, method). """
+        with self._lock:
+            series = list(self._series.items())
+        return dict((key, s.summary(self.quantiles)) for key, s in series)
+
+    def samples(self):
+        samples = []
+        for (service_key, endpoint, method), s in sorted(self.summary().items()):
+            labels = {'service': service_key, 'endpoint': endpoint, 'method': method}
+            samples.extend([
+                ('mediaamp_requests_total', labels, s['count']),
+                ('mediaamp_request_errors_total', labels, s['errors']),
+                ('mediaamp_request_retries_total', labels, s['retries']),
+                ('mediaamp_request_sent_bytes_total', labels, s['request_bytes']),
+                ('mediaamp_request_received_bytes_total', labels, s['response_bytes']),
+            ])
+            for q in self.quantiles:
+                samples.append((
+                    'mediaamp_request_duration_seconds',
+                    dict(labels, quantile=str(q)),
+                    s[_quantile_name(q)],
+                ))
+        with self._lock:
+            refreshes = sorted(self.token_refreshes.items())
+        for source, count in refreshes:
+            samples.append(('mediaamp_token_refreshes_total', {'source': source}, count))
+        return samples
+
+    def prometheus(self):
+        lines = []
+        for name, labels, value in self.samples():
+            rendered = ','.join(
+                '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in sorted(labels.items())
+            )
+            lines.append('%s{%s} %s' % (name, rendered, value))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+            self.token_refreshes = {}
+
+
+class _Series(object):
+
+    def __init__(self, window):
+        self.durations = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.statuses = {}
+
+    def add(self, event):
+        self.durations.append(event.duration)
+        self.count += 1
+        if event.error is not None:
+            self.errors += 1
+        if event.attempt > 1 or event.token_retry:
+            self.retries += 1
+        self.request_bytes += event.request_bytes
+        self.response_bytes += event.response_bytes
+        self.statuses[event.status] = self.statuses.get(event.status, 0) + 1
+
+    def summary(self, quantiles):
+        durations = sorted(self.durations)
+        summary = {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'statuses': dict(self.statuses),
+        }
+        for q in quantiles:
+            summary[_quantile_name(q)] = percentile(durations, q)
+        return summary
+
+
+def percentile(ordered, q):
+    """ Nearest-rank percentile of an ordered sequence. """
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(q * len(ordered)))
+    return ordered[min(max(rank - 1, 0), len(ordered) - 1)]
+
+
+def _quantile_name(q):
+    return 'p%d' % round(q * 100)
@@ -0,0 +1,273 @@
+from datetime import datetime
+import re
+import sqlite3
+import threading
+
+from .utils import decode_datetime, encode_datetime, text_type
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    numeric_id TEXT,
+    guid TEXT,
+    title TEXT,
+    added INTEGER,
+    updated INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_numeric_id ON objects (numeric_id);
+CREATE INDEX IF NOT EXISTS objects_guid ON objects (guid);
+CREATE INDEX IF NOT EXISTS objects_title ON objects (title);
+CREATE INDEX IF NOT EXISTS objects_updated ON objects (updated);
+CREATE TABLE IF NOT EXISTS categories (
+    object_id TEXT,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS categories_name ON categories (name, object_id);
+CREATE INDEX IF NOT EXISTS categories_object ON categories (object_id);
+CREATE TABLE IF NOT EXISTS custom_values (
+    object_id TEXT,
+    field TEXT,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS custom_values_field ON custom_values (field, value, object_id);
+CREATE INDEX IF NOT EXISTS custom_values_object ON custom_values (object_id);
+"""
+
+SORTABLE = ('id', 'guid', 'title', 'added', 'updated')
+custom_value_re = re.compile(r'\{([^}]*)\}\{([^}]*)\}')
+
+
+class Mirror(object):
+    """ A local SQLite copy of the objects of a data endpoint.
+
+    ``load`` copies every object (in cjson form) with concurrent range
+    requests, ``refresh`` fetches the objects updated since the newest one
+    held, and ``apply`` consumes ``mediaamp.sync.ChangeEvent``s, which also
+    covers deletions. Objects are indexed by id, guid, title, updated date,
+    category name and custom field value.
+
+    ``get`` mirrors ``Endpoint.get`` for the supported subset of query
+    parameters (``byId``, ``byGuid``, ``byTitle``, ``byCategories``,
+    ``byCustomValue``, ``byUpdated``, ``sort``, ``range``, ``count`` and
+    ``fields``) and answers from the local copy:
+
+        mirror = Mirror(session['Media Data Service'].Media, 'media.db')
+        mirror.load()
+        mirror.get(params={'byCategories': 'News|Sports', 'sort': 'updated|desc'})
+
+    """
+
+    ignored_params = ('schema', 'form', 'account', 'pretty')
+
+    def __init__(self, endpoint, path=':memory:'):
+        self.endpoint = endpoint
+        self.codec = endpoint.service.session.codec
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.db.executescript(SCHEMA)
+
+    def load(self, page_size=500, workers=4, **kwargs):
+        """ Copy every object of the endpoint, returns the number copied. """
+        params = dict(kwargs.pop('params', {}), form='cjson')
+        entries = self.endpoint.fetch_all(page_size=page_size, workers=workers,
+                                          ordered=False, params=params, **kwargs)
+        return self.upsert(entries)
+
+    def refresh(self, page_size=500, workers=4, **kwargs):
+        """ Copy the objects updated since the newest object held. """
+        latest = self.latest_update()
+        params = dict(kwargs.pop('params', {}))
+        if latest is not None:
+            params['byUpdated'] = decode_datetime(latest).strftime('%Y-%m-%dT%H:%M:%SZ') + '~'
+        return self.load(page_size, workers, params=params, **kwargs)
+
+    def apply(self, events):
+        """ Apply change events from ``NotificationSync`` to the mirror. """
+        changed = []
+        deleted = []
+        for event in events:
+            if event.method == 'delete':
+                deleted.append(event.object_id)
+            elif event.entry is not None:
+                changed.append(event.entry)
+        self.upsert(changed)
+        self.delete(deleted)
+
+    def latest_update(self):
+        with self._lock:
+            return self.db.execute('SELECT MAX(updated) FROM objects').fetchone()[0]
+
+    def upsert(self, entries, chunk_size=1000):
+        count = 0
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                count += self._write(chunk)
+                chunk = []
+        return count + self._write(chunk)
+
+    def delete(self, object_ids):
+        rows = [(object_id,) for object_id in object_ids]
+        with self._lock, self.db:
+            for table, column in (('objects', 'id'), ('categories', 'object_id'),
+                                  ('custom_values', 'object_id')):
+                self.db.executemany('DELETE FROM %s WHERE %s = ?' % (table, column), rows)
+
+    def _write(self, entries):
+        if not entries:
+            return 0
+        objects, categories, custom_values = [], [], []
+        for entry in entries:
+            object_id = entry['id']
+            objects.append((
+                object_id,
+                object_id.rsplit('/', 1)[-1],
+                entry.get('guid'),
+                entry.get('title'),
+                entry.get('added'),
+                entry.get('updated'),
+                self.codec.dumps(entry).decode('utf-8'),
+            ))
+            for category in entry.get('categories') or []:
+                categories.append((object_id, category.get('name')))
+            for key, value in entry.items():
+                if '$' not in key:
+                    continue
+                field = key.split('$', 1)[1]
+                for item in value if isinstance(value, list) else [value]:
+                    custom_values.append((object_id, field, _text(item)))
+        ids = [(row[0],) for row in objects]
+        with self._lock, self.db:
+            self.db.executemany('DELETE FROM categories WHERE object_id = ?', ids)
+            self.db.executemany('DELETE FROM custom_values WHERE object_id = ?', ids)
+            self.db.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)', objects)
+            self.db.executemany('INSERT INTO categories VALUES (?, ?)', categories)
+            self.db.executemany('INSERT INTO custom_values VALUES (?, ?, ?)', custom_values)
+        return len(objects)
+
+    def get(self, extra_path=None, params=None):
+        """ Answer an ``Endpoint.get`` from the mirror.
+
+        Returns an object when ``extra_path`` is its id, otherwise a feed.
+        Raises ``ValueError`` for parameters the mirror can't evaluate.
+
+        """
+        params = dict(params or {})
+        fields = params.pop('fields', None)
+        fields = fields.split(',') if fields else None
+        if extra_path is not None:
+            params['byId'] = text_type(extra_path).strip('/')
+            entries, _ = self._select(params)
+            return _project(entries[0], fields) if entries else None
+
+        start, end = 1, None
+        if 'range' in params:
+            first, _, last = params.pop('range').partition('-')
+            start = int(first or 1)
+            end = int(last) if last else None
+        count = str(params.pop('count', 'false')).lower() == 'true'
+        entries, total = self._select(params, start, end, count)
+        feed = {
+            'startIndex': start,
+            'itemsPerPage': len(entries),
+            'entryCount': len(entries),
+            'entries': [_project(entry, fields) for entry in entries],
+        }
+        if count:
+            feed['totalResults'] = total
+        return feed
+
+    def _select(self, params, start=1, end=None, count=False):
+        # returns the entries and, with ``count``, the number of matches
+        where, args = [], []
+        sort = 'id'
+        for name, value in params.items():
+            if name in self.ignored_params:
+                continue
+            value = text_type(value)
+            if name in ('byId', 'byGuid', 'byTitle'):
+                column = {'byId': 'numeric_id', 'byGuid': 'guid', 'byTitle': 'title'}[name]
+                values = value.split('|')
+                where.append('%s IN (%s)' % (column, ', '.join('?' * len(values))))
+                args.extend(values)
+            elif name == 'byCategories':
+                # '|' separates alternatives, ',' categories that must all match
+                alternatives = []
+                for group in value.split('|'):
+                    names = group.split(',')
+                    alternatives.append(' AND '.join(
+                        'id IN (SELECT object_id FROM categories WHERE name = ?)' for _ in names
+                    ))
+                    args.extend(names)
+                where.append('(%s)' % ' OR '.join('(%s)' % a for a in alternatives))
+            elif name == 'byCustomValue':
+                for field, values in custom_value_re.findall(value):
+                    values = values.split('|')
+                    where.append(
+                        'id IN (SELECT object_id FROM custom_values WHERE field = ? AND value IN (%s))'
+                        % ', '.join('?' * len(values))
+                    )
+                    args.append(field)
+                    args.extend(values)
+            elif name == 'byUpdated':
+                lower, _, upper = value.partition('~')
+                if lower:
+                    where.append('updated >= ?')
+                    args.append(_millis(lower))
+                if upper:
+                    where.append('updated < ?')
+                    args.append(_millis(upper))
+            elif name == 'sort':
+                sort = _order_by(value)
+            else:
+                raise ValueError('The mirror does not support the %r parameter.' % name)
+
+        condition = ' WHERE ' + ' AND '.join(where) if where else ''
+        limit = -1 if end is None else max(end - start + 1, 0)
+        total = None
+        with self._lock:
+            if count:
+                total = self.db.execute(
+                    'SELECT COUNT(*) FROM objects' + condition, args
+                ).fetchone()[0]
+            rows = self.db.execute(
+                'SELECT data FROM objects%s ORDER BY %s LIMIT ? OFFSET ?' % (condition, sort),
+                args + [limit, start - 1],
+            ).fetchall()
+        return [self.codec.loads(row[0]) for row in rows], total
+
+
+def _order_by(sort):
+    terms = []
+    for term in sort.split(','):
+        field, _, direction = term.partition('|')
+        if field not in SORTABLE:
+            raise ValueError('The mirror can not sort by %r.' % field)
+        terms.append('%s %s' % (field, 'DESC' if direction.lower() == 'desc' else 'ASC'))
+    return ', '.join(terms)
+
+
+def _millis(value):
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return encode_datetime(datetime.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError('Unsupported date %r.' % value)
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value if isinstance(value, text_type) else text_type(value)
+
+
+def _project(entry, fields):
+    if not fields:
+        return entry
+    return dict((field, entry[field]) for field in fields if field in entry)
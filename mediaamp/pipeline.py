@@ -0,0 +1,254 @@
+""" Multi-stage processing of many items with a worker pool per stage.
+
+Stages are connected by bounded queues, so a slow stage holds back the
+ones before it instead of letting work pile up in memory, and every stage
+keeps its own requests in flight. With a ``store`` the output of the last
+stage completed for each item is checkpointed; running the pipeline again
+over the same input skips completed items and resumes the others after
+their last completed stage.
+
+    pipeline = media_ingest_pipeline(session, store=FileStore('/var/lib/ingest'),
+                                     run_id='nightly-2016-05-01')
+    for result in pipeline.run(assets):
+        if result.error is not None:
+            print(result.key, result.stage, result.error)
+    pipeline.stats()
+
+"""
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+PipelineResult = namedtuple('PipelineResult', 'key item stage error')
+
+_done = object()
+
+
+class Stage(object):
+    """ A step of a ``Pipeline``: ``fn(item)`` returns the item for the next stage. """
+
+    def __init__(self, name, fn, workers=4):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.reset()
+
+    def reset(self):
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def record(self, started, failed):
+        now = time.time()
+        with self._lock:
+            if self.started_at is None or started < self.started_at:
+                self.started_at = started
+            self.finished_at = now
+            self.busy += now - started
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+
+    def stats(self):
+        with self._lock:
+            elapsed = (self.finished_at - self.started_at) if self.started_at else 0
+            return {
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed,
+                'busy_seconds': self.busy,
+                'items_per_second': self.processed / elapsed if elapsed else 0.0,
+                'utilization': self.busy / (elapsed * self.workers) if elapsed else 0.0,
+            }
+
+
+class Pipeline(object):
+    """ Runs items through ``stages`` concurrently.
+
+    ``key(item)`` identifies an item across runs for checkpointing, and
+    ``queue_size`` bounds the number of items waiting for each stage.
+    Results are yielded as items leave the pipeline, either completed
+    (``stage`` is None) or failed at ``stage`` with ``error``. Failed
+    items are retried from that stage the next time the run is resumed.
+    Items whose key or checkpoint can't be read fail with ``key`` and
+    ``stage`` None.
+
+    """
+
+    namespace = 'pipeline'
+
+    def __init__(self, stages, key, store=None, run_id='default', queue_size=100):
+        self.stages = list(stages)
+        self.key = key
+        self.store = store
+        self.run_id = run_id
+        self.queue_size = queue_size
+        self.skipped = 0
+        self._stopped = threading.Event()
+
+    def run(self, items):
+        self.skipped = 0
+        self._stopped.clear()
+        for stage in self.stages:
+            stage.reset()
+        queues = [Queue(self.queue_size) for _ in self.stages]
+        results = Queue()
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+
+        def feed():
+            try:
+                for item in items:
+                    if self._stopped.is_set():
+                        break
+                    try:
+                        key = self.key(item)
+                        position, item = self._resume(key, item)
+                    except Exception as e:
+                        results.put(PipelineResult(None, item, None, e))
+                        continue
+                    if position == len(self.stages):
+                        self.skipped += 1
+                    else:
+                        queues[position].put((key, item))
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_done)
+
+        def process(position, key, item):
+            stage = self.stages[position]
+            started = time.time()
+            try:
+                item = stage.fn(item)
+            except Exception as e:
+                stage.record(started, True)
+                results.put(PipelineResult(key, item, stage.name, e))
+                return
+            stage.record(started, False)
+            try:
+                self._checkpoint(key, position + 1, item)
+            except Exception as e:
+                results.put(PipelineResult(key, item, stage.name, e))
+                return
+            if position == len(self.stages) - 1:
+                results.put(PipelineResult(key, item, None, None))
+            else:
+                queues[position + 1].put((key, item))
+
+        def work(position):
+            try:
+                while True:
+                    task = queues[position].get()
+                    if task is _done:
+                        break
+                    if self._stopped.is_set():
+                        continue
+                    key, item = task
+                    try:
+                        process(position, key, item)
+                    except Exception as e:
+                        results.put(PipelineResult(key, item, self.stages[position].name, e))
+            finally:
+                # the next stage (or run) waits for every worker to finish
+                with remaining_lock:
+                    remaining[position] -= 1
+                    finished = remaining[position] == 0
+                if finished:
+                    if position == len(self.stages) - 1:
+                        results.put(_done)
+                    else:
+                        for _ in range(self.stages[position + 1].workers):
+                            queues[position + 1].put(_done)
+
+        threads = [threading.Thread(target=feed, name='pipeline-feed')]
+        for position, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=work, args=(position,), name='pipeline-%s' % stage.name)
+                for _ in range(stage.workers)
+            )
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is _done:
+                    break
+                yield result
+        finally:
+            self.stop()
+
+    def stop(self):
+        """ Stop taking new work; items already in a stage are finished. """
+        self._stopped.set()
+
+    def stats(self):
+        return OrderedDict((stage.name, stage.stats()) for stage in self.stages)
+
+    def _store_key(self, key):
+        return '%s|%s' % (self.run_id, key)
+
+    def _resume(self, key, item):
+        if self.store is not None:
+            checkpoint = self.store.get(self.namespace, self._store_key(key))
+            if checkpoint is not None:
+                return checkpoint['position'], checkpoint['item']
+        return 0, item
+
+    def _checkpoint(self, key, position, item):
+        if self.store is not None:
+            self.store.set(self.namespace, self._store_key(key),
+                           {'position': position, 'item': item})
+
+
+def media_ingest_pipeline(session, store=None, run_id='ingest', media_workers=8,
+                          file_workers=8, publish_workers=4, queue_size=100):
+    """ Create Media, link their files and publish them.
+
+    Items are dicts with the ``media`` object to create (its ``guid`` keys
+    the checkpoints), the ``files`` to link, each holding the arguments of
+    the FMS ``linkNewFile`` method (``sourceUrl``, ``mediaFileInfo`` ...),
+    and the ids of the publish ``profiles``. The stages add ``media_id``,
+    ``file_ids`` and ``publish_results`` to the item.
+
+    """
+    media = session['Media Data Service'].Media
+    file_management = session['File Management Service'].FileManagement
+    publish = session['Publish Service'].Publish
+
+    def create_media(item):
+        created = media.post(json=item['media'])
+        return dict(item, media_id=created['id'])
+
+    def link_files(item):
+        file_ids = []
+        for link in item.get('files', []):
+            response = file_management.post(json={
+                'linkNewFile': dict(link, mediaId=item['media_id'])
+            })
+            file_ids.append(response.get('linkNewFileResponse'))
+        return dict(item, file_ids=file_ids)
+
+    def publish_media(item):
+        published = [
+            publish.post(json={'publish': {'mediaId': item['media_id'], 'profileId': profile}})
+            for profile in item.get('profiles', [])
+        ]
+        return dict(item, publish_results=published)
+
+    stages = [
+        Stage('media', create_media, media_workers),
+        Stage('files', link_files, file_workers),
+        Stage('publish', publish_media, publish_workers),
+    ]
+    return Pipeline(stages, key=lambda item: item['media']['guid'], store=store,
+                    run_id=run_id, queue_size=queue_size)
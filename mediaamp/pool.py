@@ -0,0 +1,89 @@
+import ssl
+
+from requests.adapters import HTTPAdapter
+
+TLS_VERSIONS = ('TLSv1', 'TLSv1.1', 'TLSv1.2', 'TLSv1.3')
+
+
+class PoolConfig(object):
+    """ Connection pool, timeout and TLS settings of a session.
+
+    urllib3 keeps one pool per host, so services on the same host share
+    their keep-alive connections. ``pools`` is the number of host pools
+    kept (the registry has some 70 hosts), ``maxsize`` the number of
+    connections kept per host; with ``block=True`` threads wait for a free
+    connection instead of opening extra ones that are discarded after use.
+    ``timeout`` is the default ``(connect, read)`` timeout in seconds.
+
+    The TLS defaults are those of ``ssl.create_default_context`` with
+    ``min_tls_version`` as the oldest protocol accepted; pass an
+    ``ssl_context`` to take full control.
+
+    """
+
+    def __init__(self, pools=100, maxsize=10, block=False, timeout=(3.05, 60),
+                 min_tls_version='TLSv1.2', ssl_context=None, max_retries=0):
+        self.pools = pools
+        self.maxsize = maxsize
+        self.block = block
+        self.timeout = timeout
+        self.min_tls_version = min_tls_version
+        self.ssl_context = ssl_context or tls_context(min_tls_version)
+        self.max_retries = max_retries
+
+
+def tls_context(min_tls_version='TLSv1.2'):
+    """ A default client SSL context refusing protocols older than ``min_tls_version``. """
+    if min_tls_version not in TLS_VERSIONS:
+        raise ValueError('Unknown TLS version %r.' % min_tls_version)
+    context = ssl.create_default_context()
+    if hasattr(ssl, 'TLSVersion'):
+        context.minimum_version = getattr(ssl.TLSVersion, min_tls_version.replace('.', '_'))
+    else:  # Python < 3.7
+        for version, option in zip(TLS_VERSIONS, ('OP_NO_TLSv1', 'OP_NO_TLSv1_1', 'OP_NO_TLSv1_2')):
+            if version == min_tls_version:
+                break
+            context.options |= getattr(ssl, option)
+    return context
+
+
+class PooledAdapter(HTTPAdapter):
+    """ An HTTPAdapter configured from a ``PoolConfig``. """
+
+    def __init__(self, config=None):
+        self.pool_config = config or PoolConfig()
+        super(PooledAdapter, self).__init__(
+            pool_connections=self.pool_config.pools,
+            pool_maxsize=self.pool_config.maxsize,
+            max_retries=self.pool_config.max_retries,
+            pool_block=self.pool_config.block,
+        )
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('ssl_context', self.pool_config.ssl_context)
+        super(PooledAdapter, self).init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.pool_config.timeout
+        return super(PooledAdapter, self).send(request, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """ Utilization of the connection pool of every host contacted. """
+        stats = {}
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            with pool.pool.mutex:
+                slots = list(pool.pool.queue)
+            origin = '%s://%s:%s' % (key.key_scheme, key.key_host, key.key_port or pool.port)
+            stats[origin] = {
+                'maxsize': self.pool_config.maxsize,
+                'in_use': self.pool_config.maxsize - len(slots),
+                'idle': len([conn for conn in slots if conn is not None]),
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+        return stats
@@ -0,0 +1,79 @@
+import threading
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """ Allows ``rate`` operations per second with bursts of ``capacity``.
+
+    ``reserve`` never blocks: it takes the tokens, possibly going into debt,
+    and returns how long the caller has to wait before proceeding. This
+    keeps callers in arrival order and lets the same bucket be used from
+    threads (``acquire``) and coroutines (``await asyncio.sleep(reserve())``).
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = _clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            now = _clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class RateLimiter(object):
+    """ Token buckets per account and registry service key.
+
+    ``limits`` maps service keys (e.g. ``'Media Data Service'``) to either
+    requests per second or a ``(rate, burst)`` tuple; ``default`` applies to
+    any other service and may be ``None`` for no limit. One limiter can be
+    shared by every session of a process, each account gets its own buckets.
+
+        limiter = RateLimiter({'Publish Service': 2}, default=(20, 40))
+        session = Session(username, password, account_id, rate_limiter=limiter)
+
+    """
+
+    def __init__(self, limits=None, default=None):
+        self.limits = dict(limits or {})
+        self.default = default
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, account, service_key):
+        key = (account, service_key)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            limit = self.limits.get(service_key, self.default)
+            if limit is None:
+                return None
+            if not isinstance(limit, (tuple, list)):
+                limit = (limit,)
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(*limit))
+        return bucket
+
+    def reserve(self, account, service_key):
+        bucket = self.bucket(account, service_key)
+        return bucket.reserve() if bucket is not None else 0
+
+    def acquire(self, account, service_key):
+        delay = self.reserve(account, service_key)
+        if delay:
+            time.sleep(delay)
@@ -0,0 +1,165 @@
+""" Compact representations of feed entries.
+
+A dict per entry costs several hundred bytes before its values are counted.
+``Records`` turns entries into instances of ``__slots__`` classes built
+once per set of fields, so scans holding many entries use a fraction of
+the memory, especially when combined with the MPX ``fields`` parameter:
+
+    to_record = Records(['id', 'title', 'updated', 'pl1$show'])
+    for media in media_data.Media.iter_all(fields=to_record.fields, records=to_record):
+        media.title, media.pl1_show, media.updated.year
+
+Attributes are the field names with characters that are not valid in
+identifiers (e.g. the ``$`` of namespaced fields) replaced by ``_``; items
+can also be read by their original name (``media['pl1$show']``). Missing
+fields are ``None``. Millisecond timestamps (``added``, ``updated`` and
+fields ending in ``Date``) are kept as integers and only decoded with
+``decode_datetime`` when read. Nested values are left as they are.
+
+"""
+from collections import OrderedDict
+import keyword
+import re
+import threading
+
+from .utils import decode_datetime, string_types
+
+_invalid = re.compile(r'\W')
+
+
+def attribute_name(field):
+    name = _invalid.sub('_', field)
+    if not name or name[0].isdigit() or keyword.iskeyword(name):
+        name = '_' + name
+    return name
+
+
+def is_datetime_field(field):
+    return field in ('added', 'updated') or field.endswith('Date')
+
+
+class Record(object):
+    """ Base class of the record types created by ``record_type``. """
+
+    __slots__ = ()
+    _fields = ()
+    _attributes = {}
+    _attributes_in_order = ()
+    _slots_in_order = ()
+    _lazy = frozenset()
+
+    def __init__(self, *values):
+        for slot, value in zip(self._slots_in_order, values):
+            setattr(self, slot, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, self._attributes[field])
+        except KeyError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def raw(self, field):
+        """ The value of ``field`` as received, without decoding timestamps. """
+        attribute = self._attributes[field]
+        if attribute in self._lazy:
+            attribute = '_raw_' + attribute
+        return getattr(self, attribute)
+
+    def _asdict(self, decode=False):
+        if decode:
+            return dict((field, self[field]) for field in self._fields)
+        return dict((field, self.raw(field)) for field in self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._asdict() == other._asdict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (attribute, self.raw(field)) for field, attribute in
+            zip(self._fields, self._attributes_in_order)
+        ))
+
+
+class _LazyDatetime(object):
+
+    def __init__(self, attribute):
+        self.raw = '_raw_' + attribute
+
+    def __get__(self, record, owner):
+        if record is None:
+            return self
+        value = getattr(record, self.raw)
+        return decode_datetime(value) if isinstance(value, (int, float)) else value
+
+    def __set__(self, record, value):
+        setattr(record, self.raw, value)
+
+
+def record_type(fields, name='Record'):
+    """ Create a ``Record`` subclass with a slot for every field in ``fields``. """
+    fields = tuple(fields)
+    attributes = [attribute_name(field) for field in fields]
+    if len(set(attributes)) != len(attributes):
+        raise ValueError('Fields %r do not map to distinct attributes.' % (fields,))
+    lazy = frozenset(a for f, a in zip(fields, attributes) if is_datetime_field(f))
+    slots = tuple('_raw_' + a if a in lazy else a for a in attributes)
+    namespace = {
+        '__slots__': slots,
+        '_slots_in_order': slots,
+        '_fields': fields,
+        '_attributes': dict(zip(fields, attributes)),
+        '_attributes_in_order': tuple(attributes),
+        '_lazy': lazy,
+    }
+    for attribute in lazy:
+        namespace[attribute] = _LazyDatetime(attribute)
+    return type(name, (Record,), namespace)
+
+
+class Records(object):
+    """ Converts entries into records.
+
+    With ``fields`` every record has exactly those fields; otherwise a
+    record type is created (and reused) for each distinct set of keys. At
+    most ``max_types`` of those are kept, the oldest are forgotten first.
+
+    """
+
+    def __init__(self, fields=None, name='Record', max_types=256):
+        if isinstance(fields, string_types):
+            fields = fields.split(',')
+        self.fields = tuple(fields) if fields else None
+        self.name = name
+        self.max_types = max_types
+        self._types = OrderedDict()
+        self._lock = threading.Lock()
+        if self.fields:
+            self._types[self.fields] = record_type(self.fields, name)
+
+    def type_for(self, fields):
+        cls = self._types.get(fields)
+        if cls is None:
+            with self._lock:
+                cls = self._types.get(fields)
+                if cls is None:
+                    cls = self._types[fields] = record_type(fields, self.name)
+                    while len(self._types) > self.max_types:
+                        self._types.popitem(last=False)
+        return cls
+
+    def __call__(self, entry):
+        fields = self.fields or tuple(entry)
+        cls = self.type_for(fields)
+        get = entry.get
+        return cls(*[get(field) for field in fields])
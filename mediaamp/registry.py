@@ -0,0 +1,89 @@
+""" Service URLs looked up in the registry returned by ``resolveDomain``.
+
+The registry maps keys to base URLs. Besides the primary host of a service
+it can list a ``read-only`` host and variants such as ``Access Data Service
+audience``, each of which may have a read-only host of its own. The keys
+are parsed once into a ``ServiceIndex`` so looking up a URL is a single
+dict access.
+
+"""
+from collections import namedtuple
+
+READ_ONLY_SUFFIX = ' read-only'
+
+ServiceHosts = namedtuple('ServiceHosts', 'key service variant primary read_only')
+
+
+def split_key(key, keys):
+    """ Split a registry key into ``(key, service, variant, read_only)``.
+
+    ``keys`` are all the keys of the registry, a trailing lowercase word is
+    a variant when the rest of the key is a service in the registry.
+
+    """
+    read_only = key.endswith(READ_ONLY_SUFFIX)
+    if read_only:
+        key = key[:-len(READ_ONLY_SUFFIX)]
+    service, variant = key, None
+    if ' ' in key:
+        head, tail = key.rsplit(' ', 1)
+        if tail.islower() and (head in keys or head + READ_ONLY_SUFFIX in keys):
+            service, variant = head, tail
+    return key, service, variant, read_only
+
+
+class ServiceIndex(object):
+    """ The URLs of a registry by service key.
+
+    URLs are rewritten to HTTPS up front when ``use_ssl`` is set. A service
+    that only has a read-only host uses it for writes too, and the other way
+    around.
+
+    """
+
+    def __init__(self, registry, use_ssl=True):
+        self.registry = registry
+        self.use_ssl = use_ssl
+        self._hosts = {}
+        self._variants = {}
+        keys = frozenset(registry)
+        found = {}
+        for raw_key, url in registry.items():
+            key, service, variant, read_only = split_key(raw_key, keys)
+            hosts = found.setdefault(key, {'service': service, 'variant': variant})
+            hosts['read_only' if read_only else 'primary'] = self._url(url)
+        for key, hosts in found.items():
+            primary = hosts.get('primary') or hosts.get('read_only')
+            read_only = hosts.get('read_only') or primary
+            self._hosts[key] = ServiceHosts(key, hosts['service'], hosts['variant'],
+                                            primary, read_only)
+            if hosts['variant'] is not None:
+                self._variants.setdefault(hosts['service'], []).append(hosts['variant'])
+
+    def _url(self, url):
+        if self.use_ssl and url.startswith('http://'):
+            return 'https://' + url[len('http://'):]
+        return url
+
+    def __contains__(self, key):
+        return key in self._hosts
+
+    def __iter__(self):
+        return iter(self._hosts)
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def hosts(self, key):
+        try:
+            return self._hosts[key]
+        except KeyError:
+            raise KeyError(key + ' not available.')
+
+    def url(self, key, read_only=False):
+        hosts = self.hosts(key)
+        return hosts.read_only if read_only else hosts.primary
+
+    def variants(self, key):
+        """ The variants of a service, e.g. ``['audience', 'master']``. """
+        return sorted(self._variants.get(key, ()))
@@ -0,0 +1,151 @@
+from email.utils import mktime_tz, parsedate_tz
+import random
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+from .exceptions import ServerError, TooManyRequests
+
+
+class RetryPolicy(object):
+    """ Decides which failed requests are retried and how long to wait.
+
+    Errors that are instances of ``retry_on`` (or of the session's transport
+    errors, e.g. connection resets and timeouts) are retried up to
+    ``max_attempts`` times in total, waiting an exponentially growing,
+    jittered delay capped at ``max_backoff`` seconds. A ``Retry-After``
+    header sent with the error takes precedence over the computed delay, up
+    to ``max_retry_after`` seconds (``max_backoff`` by default); errors
+    asking for a longer wait are raised instead of retried.
+
+    Only methods listed in ``idempotent_methods`` are retried unless the
+    caller passes ``idempotent=True`` for the request.
+
+    With ``breaker_threshold`` set, each service host gets a
+    ``CircuitBreaker`` that opens after that many consecutive failures and
+    rejects requests for ``breaker_reset`` seconds. Sharing one policy
+    between sessions shares their breakers.
+
+    """
+
+    def __init__(self,
+                 max_attempts=3,
+                 backoff=0.5,
+                 max_backoff=30,
+                 jitter=True,
+                 retry_on=(ServerError, TooManyRequests),
+                 respect_retry_after=True,
+                 idempotent_methods=('get', 'head', 'options'),
+                 breaker_threshold=None,
+                 breaker_reset=30,
+                 max_retry_after=None,
+                 ):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+        self.respect_retry_after = respect_retry_after
+        self.idempotent_methods = idempotent_methods
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.max_retry_after = max_backoff if max_retry_after is None else max_retry_after
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def is_failure(self, error, transport_errors=()):
+        return isinstance(error, self.retry_on + tuple(transport_errors))
+
+    def should_retry(self, method, error, attempt, idempotent=None, transport_errors=()):
+        if attempt >= self.max_attempts:
+            return False
+        if idempotent is None:
+            idempotent = method.lower() in self.idempotent_methods
+        if not idempotent or not self.is_failure(error, transport_errors):
+            return False
+        retry_after = self.retry_after(error)
+        return retry_after is None or retry_after <= self.max_retry_after
+
+    def retry_after(self, error):
+        """ Seconds the server asked to wait with ``error``, if respected. """
+        if not self.respect_retry_after:
+            return None
+        return parse_retry_after(getattr(error, 'retry_after', None))
+
+    def delay(self, attempt, error=None):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            delay = min(retry_after, self.max_retry_after)
+        return delay
+
+    def breaker(self, url):
+        """ The circuit breaker for the host of ``url``, if enabled. """
+        if self.breaker_threshold is None:
+            return None
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self._breakers[host]
+
+
+class CircuitBreaker(object):
+    """ Fails fast once a service has failed repeatedly.
+
+    After ``threshold`` consecutive failures the breaker opens and ``allow``
+    returns false for ``reset_timeout`` seconds. Then a single trial request
+    is let through: success closes the breaker, failure opens it again.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, failed):
+        with self._lock:
+            if not failed:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+def parse_retry_after(value):
+    """ Seconds to wait according to a ``Retry-After`` header value. """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(mktime_tz(parsed) - time.time(), 0)
@@ -0,0 +1,99 @@
+""" Routing of reads to the read-only hosts of services.
+
+Most data services list a ``read-only`` host in the registry next to their
+primary host. With a ``ReadRouting`` passed to the session, endpoint GETs go
+to the read-only host while writes keep going to the primary:
+
+    from mediaamp.routing import ReadRouting
+
+    session = mediaamp.Session(username, password, account_id,
+                               routing=ReadRouting(pin_window=5))
+
+Read-only hosts can lag behind the primary, so for ``pin_window`` seconds
+after a write to a service its reads are sent to the primary (read your
+writes). A GET failing on a read-only host with a server or transport error
+is sent again to the primary, and after ``failure_threshold`` consecutive
+failures the host is skipped for ``recovery_time`` seconds.
+
+"""
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+from .exceptions import CircuitOpenError, ServerError
+from .retry import CircuitBreaker
+
+
+class ReadRouting(object):
+    """ Decides whether GETs go to read-only hosts, see the module docstring. """
+
+    failures = (ServerError, CircuitOpenError)
+
+    def __init__(self, pin_window=0, failure_threshold=3, recovery_time=30):
+        self.pin_window = pin_window
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failovers = 0
+        self._written = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def use_replica(self, service_key, url):
+        """ Whether a GET of ``service_key`` should be sent to ``url``. """
+        use = not self.pinned(service_key) and self.breaker(url).allow()
+        with self._lock:
+            if use:
+                self.replica_reads += 1
+            else:
+                self.primary_reads += 1
+        return use
+
+    def pinned(self, service_key):
+        if not self.pin_window:
+            return False
+        with self._lock:
+            written = self._written.get(service_key)
+        return written is not None and time.time() - written < self.pin_window
+
+    def wrote(self, service_key):
+        if self.pin_window:
+            with self._lock:
+                self._written[service_key] = time.time()
+
+    def breaker(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold,
+                                                      self.recovery_time)
+            return self._breakers[host]
+
+    def record(self, url, error=None, transport_errors=()):
+        """ Record the outcome of a GET sent to ``url``.
+
+        Returns true when ``error`` means the host is unhealthy and the GET
+        should be sent to the primary instead.
+
+        """
+        failed = isinstance(error, self.failures + tuple(transport_errors))
+        self.breaker(url).record(failed)
+        if failed:
+            with self._lock:
+                self.failovers += 1
+        return failed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'replica_reads': self.replica_reads,
+                'primary_reads': self.primary_reads,
+                'failovers': self.failovers,
+                'unhealthy': sorted(host for host, breaker in self._breakers.items()
+                                    if breaker.state != CircuitBreaker.CLOSED),
+            }
@@ -1,15 +1,27 @@
+from collections import namedtuple
 from functools import partial
+import json
 import re
-from .exceptions import ServiceNotAvailable
+from .concurrency import bounded_map, prefetch
+from .exceptions import MediaAmpError, ServiceNotAvailable, raise_for_json_exception
+from .records import Records
+from .utils import string_types
 
 services = {}
 
+BatchResult = namedtuple('BatchResult', 'index entry result error')
+
+_words = re.compile('[A-Z][^A-Z]*')
+
+
 def register(cls):
     if issubclass(cls, BaseService):
         key = getattr(cls, 'registry_key', None)
         if not key:
-            key = ' '.join(re.findall('[A-Z][^A-Z]*', cls.__name__))
+            key = ' '.join(_words.findall(cls.__name__))
+            cls.registry_key = key
         services[key] = cls
+    return cls
 
 
 class Endpoint(object):
@@ -21,8 +33,24 @@ class Endpoint(object):
         self.default_params = kwargs.copy()
         self.default_params.setdefault('schema', '1.0')
 
+    def bind(self, service, name=None):
+        """ Return a copy of this endpoint attached to ``service``. """
+        return self.__class__(
+            path=self.path,
+            name=self.name if self.name is not None else name,
+            service=service,
+            **self.default_params
+        )
+
     def urljoin(self, *args):
-        parts = (self.service.base_url, self.path, self.name) + args
+        return self._join(self.service.base_url, args)
+
+    def read_urljoin(self, *args):
+        """ ``urljoin`` on the read-only host of the service. """
+        return self._join(self.service.read_url, args)
+
+    def _join(self, base_url, args):
+        parts = (base_url, self.path, self.name) + args
         return '/'.join([
             part.lstrip('/') for part in parts if part is not None
         ]).rstrip('/')
@@ -39,13 +67,194 @@ class Endpoint(object):
     def delete(self, extra_path=None, **kwargs):
         return self._make_request('delete', extra_path, **kwargs)
 
-    def _make_request(self, method, extra_path=None, **kwargs):
+    def stream(self, extra_path=None, **kwargs):
+        """ GET a feed, yielding entries as they are decoded.
+
+        See ``Session.stream_json``, memory use is bounded by the size of an
+        entry instead of the size of the response. ``fields`` and ``records``
+        work as for ``iter_all``.
+
+        """
+        records = _records(kwargs.pop('records', None), kwargs.get('fields'))
+        if records is not None:
+            self._require_sync('stream with records')
+        params = self._params(kwargs)
+        kwargs.setdefault('service_key', self.service.registry_key)
+        kwargs.setdefault('endpoint', self.name)
+        replica_url = self._replica_url(extra_path)
+        if replica_url is not None:
+            kwargs.setdefault('replica_url', replica_url)
+        url = self.urljoin(extra_path)
+        entries = self.service.session.stream_json('get', url, params=params, **kwargs)
+        return _as_records(entries, records)
+
+    def iter_all(self, extra_path=None, page_size=500, prefetch_pages=False, records=None,
+                 **kwargs):
+        """ Iterate over every entry of a feed one page at a time.
+
+        Pages are requested with the MPX ``range`` parameter until a short
+        page is returned. When ``prefetch_pages`` is set the next page is
+        fetched on a background thread while the current one is consumed.
+
+        Like every request method this accepts ``fields``, the fields MPX
+        should return, as a list or comma separated string. Entries are
+        yielded as compact records (see ``mediaamp.records``) instead of
+        dicts when ``records`` is true or a ``Records`` instance.
+
+        """
+        self._require_sync('iter_all')
+        records = _records(records, kwargs.get('fields'))
+        pages = self._iter_pages(extra_path, page_size, records, **kwargs)
+        if prefetch_pages:
+            pages = prefetch(pages)
+        for entries in pages:
+            for entry in entries:
+                yield entry
+
+    def fetch_all(self, extra_path=None, page_size=500, workers=4, max_in_flight=None,
+                  ordered=True, records=None, **kwargs):
+        """ Fetch every entry of a feed using concurrent ``range`` requests.
+
+        The first page is requested with ``count=true`` to learn
+        ``totalResults``; the remaining pages are then fetched on a pool of
+        ``workers`` threads with at most ``max_in_flight`` requests
+        outstanding. Entries are yielded in feed order unless ``ordered`` is
+        false, in which case pages are yielded as they arrive. ``fields`` and
+        ``records`` work as for ``iter_all``.
+
+        """
+        self._require_sync('fetch_all')
+        records = _records(records, kwargs.get('fields'))
+        params = kwargs.pop('params', {})
+        first_page = dict(params, count='true', range='1-%d' % page_size)
+        feed = self.get(extra_path, params=first_page, **kwargs)
+        entries = list(_as_records(feed.get('entries', []), records))
+        total = feed.get('totalResults', len(entries))
+
+        def fetch(start):
+            end = min(start + page_size - 1, total)
+            page_params = dict(params, range='%d-%d' % (start, end))
+            page = self.get(extra_path, params=page_params, **kwargs).get('entries', [])
+            return list(_as_records(page, records))
+
+        for entry in entries:
+            yield entry
+        starts = range(page_size + 1, total + 1, page_size)
+        for entries in bounded_map(fetch, starts, workers, max_in_flight, ordered):
+            for entry in entries:
+                yield entry
+
+    def bulk_update(self, entries, **kwargs):
+        """ Update many objects with feed PUTs, see ``bulk_write``. """
+        return self.bulk_write('put', entries, **kwargs)
+
+    def bulk_create(self, entries, **kwargs):
+        """ Create many objects with feed POSTs, see ``bulk_write``. """
+        return self.bulk_write('post', entries, **kwargs)
+
+    def bulk_write(self, method, entries, batch_size=100, max_bytes=1048576, workers=4,
+                   max_in_flight=None, isolate_failures=True, namespaces=None, **kwargs):
+        """ Send ``entries`` as feeds of up to ``batch_size`` objects.
+
+        Batches are also capped at roughly ``max_bytes`` of JSON and are sent
+        concurrently on ``workers`` threads. A ``BatchResult`` is yielded for
+        every entry, in input order, holding the object returned by MPX or
+        the exception raised for it. When a whole batch is rejected and
+        ``isolate_failures`` is set, its entries are resent one at a time so
+        only the offending objects are reported as failed.
+
+        Connection errors and timeouts fail every entry of the batch, since
+        MPX may have applied it; its entries are only resent one at a time
+        when the request is marked ``idempotent``. Either way one failing
+        batch never stops the others.
+
+        """
+        self._require_sync('bulk_write')
+        transport_errors = tuple(self.service.session.transport_errors)
+        resend_on_transport_error = kwargs.get('idempotent') is True
+
+        def send(batch):
+            try:
+                return self._send_batch(method, batch, namespaces, **kwargs)
+            except MediaAmpError as e:
+                if not isolate_failures or len(batch) == 1:
+                    return [(index, entry, None, e) for index, entry in batch]
+            except transport_errors as e:
+                if not (isolate_failures and resend_on_transport_error) or len(batch) == 1:
+                    return [(index, entry, None, e) for index, entry in batch]
+            results = []
+            for item in batch:
+                results.extend(send([item]))
+            return results
+
+        batches = _batches(entries, batch_size, max_bytes)
+        for results in bounded_map(send, batches, workers, max_in_flight):
+            for result in results:
+                yield BatchResult(*result)
+
+    def _send_batch(self, method, batch, namespaces, **kwargs):
+        feed = {'entries': [entry for index, entry in batch]}
+        if namespaces:
+            feed['$xmlns'] = namespaces
+        response = self._make_request(method, json=feed, **kwargs)
+        returned = (response or {}).get('entries') or []
+        if len(returned) != len(batch):
+            error = MediaAmpError('Expected %d entries in the response, got %d.'
+                                  % (len(batch), len(returned)))
+            return [(index, entry, None, error) for index, entry in batch]
+        results = []
+        for (index, entry), result in zip(batch, returned):
+            error = None
+            try:
+                raise_for_json_exception(result)
+            except MediaAmpError as e:
+                result, error = None, e
+            results.append((index, entry, result, error))
+        return results
+
+    def _iter_pages(self, extra_path, page_size, records=None, **kwargs):
+        params = kwargs.pop('params', {})
+        start = 1
+        while True:
+            page_params = dict(params, range='%d-%d' % (start, start + page_size - 1))
+            feed = self.get(extra_path, params=page_params, **kwargs)
+            entries = feed.get('entries', [])
+            yield list(_as_records(entries, records))
+            if len(entries) < page_size:
+                return
+            start += page_size
+
+    def _params(self, kwargs):
         # merge default parameters with those supplied
         params = dict(self.default_params, **kwargs.pop('params', {}))
-        extra_path = extra_path
+        fields = kwargs.pop('fields', None)
+        if fields:
+            params['fields'] = fields if isinstance(fields, string_types) else ','.join(fields)
+        return params
+
+    def _make_request(self, method, extra_path=None, **kwargs):
+        params = self._params(kwargs)
         url = self.urljoin(extra_path)
+        kwargs.setdefault('service_key', self.service.registry_key)
+        kwargs.setdefault('endpoint', self.name)
+        replica_url = self._replica_url(extra_path)
+        if replica_url is not None:
+            kwargs.setdefault('replica_url', replica_url)
         return self.service.session.request_json(method, url, params=params, **kwargs)
 
+    def _require_sync(self, helper):
+        if getattr(self.service.session, 'is_async', False) is True:
+            raise MediaAmpError('%s is not available on an AsyncSession.' % helper)
+
+    def _replica_url(self, extra_path):
+        # the read-only URL a GET may be sent to, or to invalidate and pin
+        # reads to the primary after a write; the session decides right
+        # before sending
+        routing = getattr(self.service.session, 'routing', None)
+        if routing is None or self.service.read_url == self.service.base_url:
+            return None
+        return self.read_urljoin(extra_path)
+
     def __call__(self, **kwargs):
         """ Override default URL parameters.
 
@@ -57,24 +266,52 @@ class Endpoint(object):
         return self
 
 
+def _records(records, fields=None):
+    if records is True:
+        return Records(fields)
+    return records or None
+
+
+def _as_records(entries, records):
+    if records is None:
+        return entries
+    return (records(entry) for entry in entries)
+
+
+def _batches(entries, batch_size, max_bytes):
+    batch, size = [], 0
+    for index, entry in enumerate(entries):
+        entry_size = len(json.dumps(entry, separators=(',', ':')))
+        if batch and (len(batch) >= batch_size or size + entry_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append((index, entry))
+        size += entry_size
+    if batch:
+        yield batch
+
+
 class BaseService(object):
 
-    def __init__(self, session, base_url):
+    registry_key = None
+
+    def __init__(self, session, base_url, read_url=None):
         self.session = session
         self.base_url = base_url
+        self.read_url = read_url or base_url
         self.init_endpoints()
 
     def init_endpoints(self):
-        for k, v in self.__class__.__dict__.items():
-            if isinstance(v, Endpoint):
-                v.service = self
-                v(account=self.session.account)
-                if v.name is None:
-                    v.name = k
-
-    @property
-    def Notifications(self):
-        return Endpoint(name='notify', service=self, account=self.session.account)
+        # endpoints declared on the class are templates, each service
+        # instance gets its own bound copies
+        for cls in reversed(self.__class__.__mro__):
+            for k, v in vars(cls).items():
+                if isinstance(v, Endpoint):
+                    endpoint = v.bind(self, k)
+                    endpoint(account=self.session.account)
+                    setattr(self, k, endpoint)
+
+    Notifications = Endpoint(name='notify')
 
 
 DataEndpoint = partial(Endpoint, path='data')
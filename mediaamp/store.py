@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+
+class BaseStore(object):
+    """ Key/value storage for state shared between sessions and processes.
+
+    Values must be JSON serializable. Keys are grouped by ``namespace``
+    (e.g. ``'token'`` or ``'registry'``) and may expire at a given epoch time.
+
+    """
+
+    def get(self, namespace, key):
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, expires_at=None):
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, namespace, key):
+        """ Exclusive lock on ``key`` held for the duration of the block. """
+        yield
+
+
+class MemoryStore(BaseStore):
+    """ Store shared by the sessions of a single process. """
+
+    def __init__(self):
+        self._data = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def get(self, namespace, key):
+        value, expires_at = self._data.get((namespace, key), (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return value
+
+    def set(self, namespace, key, value, expires_at=None):
+        self._data[(namespace, key)] = (value, expires_at)
+
+    def delete(self, namespace, key):
+        self._data.pop((namespace, key), None)
+
+    @contextmanager
+    def lock(self, namespace, key):
+        with self._guard:
+            lock = self._locks.setdefault((namespace, key), threading.RLock())
+        with lock:
+            yield
+
+
+class FileStore(MemoryStore):
+    """ Store persisted as JSON files in ``directory``.
+
+    Writes are atomic and ``lock`` uses ``flock`` on a sidecar file, so
+    concurrent processes pointed at the same directory see each other's
+    values and can serialize work such as signing in.
+
+    """
+
+    def __init__(self, directory):
+        super(FileStore, self).__init__()
+        self.directory = directory
+
+    def path(self, namespace, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, namespace, digest + '.json')
+
+    def get(self, namespace, key):
+        try:
+            with open(self.path(namespace, key)) as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        expires_at = record.get('expires_at')
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return record.get('value')
+
+    def set(self, namespace, key, value, expires_at=None):
+        path = self.path(namespace, key)
+        _makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'value': value, 'expires_at': expires_at}, f)
+            _replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def delete(self, namespace, key):
+        try:
+            os.remove(self.path(namespace, key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @contextmanager
+    def lock(self, namespace, key):
+        with super(FileStore, self).lock(namespace, key):
+            if fcntl is None:
+                yield
+                return
+            path = self.path(namespace, key) + '.lock'
+            _makedirs(os.path.dirname(path))
+            with open(path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+_replace = getattr(os, 'replace', os.rename)
@@ -0,0 +1,191 @@
+import codecs
+import json
+import re
+
+from .exceptions import MediaAmpError, raise_for_json_exception
+
+_decoder = json.JSONDecoder()
+_incomplete = object()
+_whitespace = ' \t\n\r'
+_number_tail = re.compile(r'[0-9.eE+-]*$')
+
+
+class FeedDecoder(object):
+    """ Incrementally decodes the ``entries`` of a JSON feed.
+
+    Chunks of the response body are pushed with ``feed`` which returns the
+    entries completed so far; every other member of the feed object (e.g.
+    ``totalResults``) is collected in ``header`` and copied to the dict passed
+    in, if any, once the feed has been read successfully. Only the unparsed tail of
+    the body is buffered, so memory is bounded by the size of an entry plus
+    a chunk rather than by the size of the response.
+
+    While a value is incomplete, further chunks are only collected until as
+    much data has arrived as was buffered, so a large entry is decoded a
+    logarithmic number of times rather than once per chunk.
+
+    ``close`` must be called once the body is exhausted; it checks that the
+    document was complete and raises for MPX ``isException`` responses.
+
+    """
+
+    def __init__(self, header=None):
+        self.header = {}
+        self.streamed = 0
+        self._target = header
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._chunks = []
+        self._received = 0
+        self._wanted = 0
+        self._eof = False
+        self._key = None
+        self._state = self._start
+
+    def feed(self, data):
+        if isinstance(data, bytes):
+            data = self._text.decode(data)
+        self._chunks.append(data)
+        self._received += len(data)
+        if self._received < self._wanted and not self._eof:
+            return []
+        self._buffer = self._buffer[self._pos:] + ''.join(self._chunks)
+        self._pos = 0
+        self._chunks = []
+        self._received = self._wanted = 0
+        entries = []
+        while self._state(entries):
+            pass
+        return entries
+
+    def close(self):
+        self._eof = True
+        entries = self.feed(self._text.decode(b'', True))
+        if self._state != self._done:
+            raise MediaAmpError('Response body can not be read as JSON. ')
+        raise_for_json_exception(self.header)
+        if self._target is not None:
+            self._target.update(self.header)
+        return entries
+
+    def _skip(self):
+        buf, pos = self._buffer, self._pos
+        while pos < len(buf) and buf[pos] in _whitespace:
+            pos += 1
+        self._pos = pos
+        return buf[pos] if pos < len(buf) else None
+
+    def _expect(self, chars):
+        char = self._skip()
+        if char is not None:
+            if char not in chars:
+                raise MediaAmpError('Unexpected %r in JSON feed.' % char)
+            self._pos += 1
+        return char
+
+    def _value(self):
+        self._skip()
+        try:
+            value, end = _decoder.raw_decode(self._buffer, self._pos)
+        except ValueError:
+            if self._eof:
+                raise MediaAmpError('Response body can not be read as JSON. ')
+            return self._incomplete()
+        if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and not self._eof and _number_tail.match(self._buffer, end)):
+            # the number could continue in the next chunk (e.g. "1." + "5")
+            return self._incomplete()
+        self._pos = end
+        return value
+
+    def _incomplete(self):
+        # wait for at least as much data as is buffered before trying again
+        self._wanted = len(self._buffer) - self._pos
+        return _incomplete
+
+    def _start(self, entries):
+        if self._expect('{') is None:
+            return False
+        self._state = self._member
+        return True
+
+    def _member(self, entries):
+        char = self._skip()
+        if char is None:
+            return False
+        if char == '}':
+            self._pos += 1
+            self._state = self._done
+            return True
+        key = self._value()
+        if key is _incomplete:
+            return False
+        self._key = key
+        self._state = self._colon
+        return True
+
+    def _colon(self, entries):
+        if self._expect(':') is None:
+            return False
+        self._state = self._entries if self._key == 'entries' else self._member_value
+        return True
+
+    def _member_value(self, entries):
+        value = self._value()
+        if value is _incomplete:
+            return False
+        self.header[self._key] = value
+        self._state = self._member_end
+        return True
+
+    def _member_end(self, entries):
+        char = self._expect(',}')
+        if char is None:
+            return False
+        self._state = self._member if char == ',' else self._done
+        return True
+
+    def _entries(self, entries):
+        if self._expect('[') is None:
+            return False
+        self._state = self._entry
+        return True
+
+    def _entry(self, entries):
+        char = self._skip()
+        if char is None:
+            return False
+        if char == ']':
+            self._pos += 1
+            self._state = self._member_end
+            return True
+        value = self._value()
+        if value is _incomplete:
+            return False
+        entries.append(value)
+        self.streamed += 1
+        self._state = self._entry_end
+        return True
+
+    def _entry_end(self, entries):
+        char = self._expect(',]')
+        if char is None:
+            return False
+        self._state = self._entry if char == ',' else self._member_end
+        return True
+
+    def _done(self, entries):
+        if self._skip() is not None:
+            raise MediaAmpError('Unexpected data after JSON feed.')
+        return False
+
+
+def iter_entries(chunks, header=None):
+    """ Yield feed entries decoded from an iterable of body chunks. """
+    decoder = FeedDecoder(header)
+    for chunk in chunks:
+        for entry in decoder.feed(chunk):
+            yield entry
+    for entry in decoder.close():
+        yield entry
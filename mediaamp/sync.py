@@ -0,0 +1,150 @@
+from collections import namedtuple, OrderedDict
+import time
+
+from .concurrency import bounded_map
+
+ChangeEvent = namedtuple('ChangeEvent', 'service_key object_type method object_id sequence entry')
+
+
+class NotificationSync(object):
+    """ Follows MPX notifications and yields the objects that changed.
+
+    ``subscriptions`` maps registry keys to the object types to follow, e.g.
+    ``{'Media Data Service': ['Media', 'MediaFile']}``. Each round long-polls
+    the ``notify`` endpoint of every service (concurrently), collapses the
+    notifications to one per object and refetches the changed objects with
+    batched ``byId`` queries on ``workers`` threads. Deleted objects are
+    reported with an ``entry`` of ``None``.
+
+    The last sequence id per service is kept in ``store`` (see
+    ``mediaamp.store``) once the events of a round have been consumed, so a
+    restarted sync resumes where it stopped and events are delivered at
+    least once. Without a stored id the sync starts from the latest
+    notification, i.e. it only reports changes made from then on.
+
+        sync = NotificationSync(session, {'Media Data Service': ['Media']},
+                                store=FileStore('/var/lib/mediaamp'))
+        for event in sync.run():
+            mirror(event)
+
+    """
+
+    namespace = 'notifications'
+
+    def __init__(self, session, subscriptions, store=None, client_id='mediaampy',
+                 batch_size=100, workers=4, size=500, block=True, interval=0,
+                 fetch_params=None):
+        self.session = session
+        self.subscriptions = OrderedDict(
+            (key, list(types)) for key, types in sorted(subscriptions.items())
+        )
+        self.store = store
+        self.client_id = client_id
+        self.batch_size = batch_size
+        self.workers = workers
+        self.size = size
+        self.block = block
+        self.interval = interval
+        self.fetch_params = dict(fetch_params or {})
+        self.sequences = {}
+        self.stopped = False
+        self._pending = {}
+        for key in self.subscriptions:
+            if store is not None:
+                self.sequences[key] = store.get(self.namespace, self._store_key(key))
+
+    def run(self):
+        """ Yield ``ChangeEvent``s until ``stop`` is called. """
+        while not self.stopped:
+            events = self.poll()
+            for event in events:
+                yield event
+            self.commit()
+            if not events and self.interval:
+                time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped = True
+
+    def poll(self):
+        """ Run a single round and return its events, see ``commit``. """
+        keys = list(self.subscriptions)
+        events = []
+        rounds = bounded_map(self._poll_service, keys, workers=max(len(keys), 1))
+        for key, (sequence, service_events) in zip(keys, rounds):
+            self._pending[key] = sequence
+            events.extend(service_events)
+        return events
+
+    def commit(self):
+        """ Record the sequence ids of the events returned by ``poll``. """
+        for key, sequence in self._pending.items():
+            self.sequences[key] = sequence
+            if self.store is not None and sequence is not None:
+                self.store.set(self.namespace, self._store_key(key), sequence)
+        self._pending = {}
+
+    def _store_key(self, service_key):
+        return '%s|%s|%s' % (self.session.account, service_key, self.client_id)
+
+    def _poll_service(self, service_key):
+        service = self.session[service_key]
+        params = {
+            'clientId': self.client_id,
+            'filter': ','.join(self.subscriptions[service_key]),
+        }
+        since = self.sequences.get(service_key)
+        if since is None:
+            # without a starting point MPX only returns the latest sequence id
+            latest = service.Notifications.get(params=params)
+            return (latest[-1]['id'] if latest else None), []
+
+        params.update(since=since, size=self.size, block='true' if self.block else 'false')
+        notifications = service.Notifications.get(params=params) or []
+        if not notifications:
+            return since, []
+
+        changes = OrderedDict()
+        for notification in notifications:
+            entry = notification.get('entry') or {}
+            object_id = entry.get('id')
+            if object_id is None:
+                continue
+            changes.pop(object_id, None)
+            changes[object_id] = notification
+        entries = self._refetch(service, changes)
+        events = [
+            ChangeEvent(
+                service_key,
+                notification.get('type'),
+                notification.get('method'),
+                object_id,
+                notification['id'],
+                entries.get(object_id),
+            )
+            for object_id, notification in changes.items()
+        ]
+        return notifications[-1]['id'], events
+
+    def _refetch(self, service, changes):
+        batches = []
+        by_type = OrderedDict()
+        for object_id, notification in changes.items():
+            if notification.get('method') != 'delete':
+                by_type.setdefault(notification.get('type'), []).append(object_id)
+        for object_type, object_ids in by_type.items():
+            for start in range(0, len(object_ids), self.batch_size):
+                batches.append((object_type, object_ids[start:start + self.batch_size]))
+
+        def fetch(batch):
+            object_type, object_ids = batch
+            params = dict(self.fetch_params, byId='|'.join(
+                object_id.rsplit('/', 1)[-1] for object_id in object_ids
+            ))
+            return getattr(service, object_type).get(params=params).get('entries', [])
+
+        entries = {}
+        for fetched in bounded_map(fetch, batches, self.workers):
+            for entry in fetched:
+                entries[entry['id']] = entry
+        return entries
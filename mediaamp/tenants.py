@@ -0,0 +1,133 @@
+from collections import namedtuple
+import threading
+
+from .concurrency import bounded_map
+from .http import Session
+
+AccountResult = namedtuple('AccountResult', 'account result error')
+
+
+class SessionPool(object):
+    """ Sessions for many MPX accounts signed in with the same credentials.
+
+    Sessions are created on first use and share a single ``requests``
+    connection pool, so connections to the hosts the accounts have in common
+    are reused. MPX tokens belong to the user rather than the account, so
+    they also share one token: a sign-in made by any session is handed to
+    all of them and concurrent refreshes result in a single sign-in. Each
+    session keeps the registry of its account, pass a ``store`` to persist
+    registries and the token between processes.
+
+    ``map`` and ``query`` fan a call out over the accounts on a thread pool:
+
+        pool = SessionPool(username, password, accounts)
+        for result in pool.query('Media Data Service', 'Media', params={'byTitle': 'x'}):
+            print(result.account, result.error or result.result['entryCount'])
+
+    Keyword arguments besides those listed are passed to every ``Session``.
+
+    """
+
+    def __init__(self, username, password, accounts=(), workers=8, session_class=Session,
+                 **session_kwargs):
+        self.username = username
+        self.password = password
+        self.accounts = list(accounts)
+        self.workers = workers
+        self.session_class = session_class
+        self.session_kwargs = session_kwargs
+        self.http_session = None
+        self._token_source = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+
+    def __getitem__(self, account):
+        try:
+            return self._sessions[account]
+        except KeyError:
+            pass
+        with self._lock:
+            if account not in self._sessions:
+                self._sessions[account] = self._create_session(account)
+                if account not in self.accounts:
+                    self.accounts.append(account)
+        return self._sessions[account]
+
+    def _create_session(self, account):
+        session = self.session_class(self.username, self.password, account, **self.session_kwargs)
+        if self.http_session is None:
+            self.http_session = session.session
+        elif session.session is not None:
+            session.session.close()
+            session.session = self.http_session
+        session._token_lock = self._token_lock
+        if self._token_source is not None and session.auth_token is None:
+            self._copy_token(self._token_source, session)
+        session.post_sign_in.connect(self._share_token, sender=session, weak=False)
+        return session
+
+    def _share_token(self, source):
+        # under the pool lock so sessions being created don't miss the token
+        with self._lock:
+            self._token_source = source
+            for session in self._sessions.values():
+                if session is not source:
+                    self._copy_token(source, session)
+
+    def _copy_token(self, source, session):
+        session.auth_token = source.auth_token
+        session.token_issued_at = source.token_issued_at
+        session.token_last_used = source.token_last_used
+
+    def map(self, fn, accounts=None, workers=None, ordered=True):
+        """ Call ``fn(session)`` for each account, yielding ``AccountResult``s.
+
+        Exceptions raised for an account are returned in its result instead
+        of interrupting the other accounts.
+
+        """
+        def call(account):
+            try:
+                return AccountResult(account, fn(self[account]), None)
+            except Exception as e:
+                return AccountResult(account, None, e)
+
+        accounts = list(accounts if accounts is not None else self.accounts)
+        return bounded_map(call, accounts, workers or self.workers, ordered=ordered)
+
+    def query(self, service_key, endpoint, method='get', extra_path=None, accounts=None,
+              **kwargs):
+        """ Make the same endpoint request for each account.
+
+        The ``account`` parameter is set to each session's account so MPX
+        answers in the context of that account.
+
+        """
+        params = kwargs.pop('params', {})
+
+        def call(session):
+            bound = getattr(session[service_key], endpoint)
+            account_params = dict(params, account=session.account)
+            return getattr(bound, method)(extra_path, params=account_params, **kwargs)
+        return self.map(call, accounts)
+
+    def query_merged(self, service_key, endpoint, extra_path=None, accounts=None, **kwargs):
+        """ ``query`` with the entries of every account's feed in one feed.
+
+        Failed accounts are reported in the ``errors`` member of the feed,
+        keyed by account.
+
+        """
+        feed = {'entries': [], 'errors': {}}
+        for result in self.query(service_key, endpoint, 'get', extra_path, accounts, **kwargs):
+            if result.error is not None:
+                feed['errors'][result.account] = result.error
+            else:
+                feed['entries'].extend(result.result.get('entries', []))
+        feed['entryCount'] = len(feed['entries'])
+        return feed
+
+    def close(self):
+        for session in list(self._sessions.values()):
+            session.close()
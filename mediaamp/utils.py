@@ -2,6 +2,13 @@ from datetime import datetime
 from calendar import timegm
 from pytz import UTC
 
+try:
+    text_type = unicode
+    string_types = basestring
+except NameError:  # Python 3
+    text_type = str
+    string_types = str
+
 
 def decode_datetime(dt_in_millis):
     return datetime.fromtimestamp(dt_in_millis / 1000, UTC)
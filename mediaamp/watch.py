@@ -0,0 +1,179 @@
+from blinker import Signal
+from concurrent.futures import Future
+import logging
+import threading
+
+from .concurrency import bounded_map
+from .exceptions import JobFailed
+
+log = logging.getLogger(__name__)
+
+TASK_DONE = ('Complete',)
+TASK_FAILED = ('Failed', 'Cancelled')
+PROFILE_RESULT_DONE = ('Processed',)
+PROFILE_RESULT_FAILED = ('Error', 'Revoked')
+
+
+class StatusWatcher(object):
+    """ Waits for many MPX objects to reach a final status.
+
+    ``watch`` registers the id of an object of ``endpoint`` (e.g. a Task) and
+    returns a ``concurrent.futures.Future`` resolved with the object once its
+    ``status_field`` is one of ``done``, or failed with ``JobFailed`` when it
+    is one of ``failed``. A background thread polls every pending object
+    with ``byId`` queries of up to ``batch_size`` ids, so thousands of
+    objects cost a handful of requests per round. Completions are also sent
+    with the ``completed`` signal.
+
+    The interval between rounds adapts between ``min_interval`` and
+    ``max_interval`` seconds: it is halved after a round that completed
+    objects and grows by half after one that did not.
+
+        watcher = task_watcher(session)
+        futures = [watcher.watch(task_id) for task_id in task_ids]
+        for future in concurrent.futures.as_completed(futures):
+            print(future.result()['id'])
+
+    """
+
+    def __init__(self, endpoint, done, failed=(), status_field='status', batch_size=100,
+                 workers=4, min_interval=1.0, max_interval=60.0, params=None):
+        self.endpoint = endpoint
+        self.done = frozenset(done)
+        self.failed = frozenset(failed)
+        self.status_field = status_field
+        self.batch_size = batch_size
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.params = dict(params or {})
+        self.params.setdefault('fields', 'id,%s' % status_field)
+        self.completed = Signal()
+        self.requests = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def watch(self, object_id):
+        """ Start watching ``object_id`` (a URI or numeric id), returns a Future. """
+        object_id = str(object_id).rsplit('/', 1)[-1]
+        with self._lock:
+            idle = not self._pending
+            future = self._pending.get(object_id)
+            if future is None:
+                future = self._pending[object_id] = Future()
+        self.start()
+        if idle:
+            self.interval = self.min_interval
+            self._wakeup.set()
+        return future
+
+    def watch_async(self, object_id):
+        """ ``watch`` returning an awaitable for the running asyncio loop. """
+        import asyncio
+        return asyncio.wrap_future(self.watch(object_id))
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name='mediaamp-status-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """ Stop polling and cancel the futures of objects still pending. """
+        self._stopped = True
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def poll(self):
+        """ Run one round, returns the number of objects that completed. """
+        with self._lock:
+            for object_id in [i for i, f in self._pending.items() if f.cancelled()]:
+                del self._pending[object_id]
+            ids = list(self._pending)
+        batches = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        completed = 0
+        for entries in bounded_map(self._fetch, batches, self.workers):
+            for entry in entries:
+                completed += self._update(entry)
+        return completed
+
+    def _fetch(self, object_ids):
+        params = dict(self.params, byId='|'.join(object_ids))
+        with self._lock:
+            self.requests += 1
+        return self.endpoint.get(params=params).get('entries', [])
+
+    def _update(self, entry):
+        status = entry.get(self.status_field)
+        if status not in self.done and status not in self.failed:
+            return 0
+        object_id = entry['id'].rsplit('/', 1)[-1]
+        with self._lock:
+            future = self._pending.pop(object_id, None)
+        if future is None or not future.set_running_or_notify_cancel():
+            # cancelled by the caller since the round started
+            return 0
+        if status in self.done:
+            error = None
+            future.set_result(entry)
+        else:
+            error = JobFailed('%s is %s.' % (entry['id'], status), entry)
+            future.set_exception(error)
+        self.completed.send(self, entry=entry, error=error)
+        return 1
+
+    def _run(self):
+        while not self._stopped:
+            if not self.pending:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                completed = self.poll()
+            except Exception:
+                log.exception('Polling %s failed, retrying.', self.endpoint.name)
+                completed = 0
+            if completed:
+                self.interval = max(self.interval / 2.0, self.min_interval)
+            else:
+                self.interval = min(self.interval * 1.5, self.max_interval)
+            if self.pending:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+
+def task_watcher(session, **kwargs):
+    """ A ``StatusWatcher`` for Task Service tasks. """
+    kwargs.setdefault('done', TASK_DONE)
+    kwargs.setdefault('failed', TASK_FAILED)
+    return StatusWatcher(session['Task Service'].Task, **kwargs)
+
+
+def profile_result_watcher(session, **kwargs):
+    """ A ``StatusWatcher`` for Workflow Data Service profile results. """
+    kwargs.setdefault('done', PROFILE_RESULT_DONE)
+    kwargs.setdefault('failed', PROFILE_RESULT_FAILED)
+    return StatusWatcher(session['Workflow Data Service'].ProfileResult, **kwargs)
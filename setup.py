@@ -22,7 +22,8 @@ setup(
     author='Matt Cordial',
     url='https://github.com/cordmata/mediaampy',
     packages=find_packages(),
-    install_requires=['requests', 'blinker', 'pytz'],
+    install_requires=['requests', 'blinker', 'pytz', 'futures; python_version < "3"'],
+    extras_require={'async': ['aiohttp']},
     license='Apache 2.0',
     keywords=('MediaAmp', 'thePlatform'),
     classifiers=(
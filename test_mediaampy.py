@@ -1,10 +1,34 @@
 import datetime
 import json
+import ssl
+import sys
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 import mediaamp
+from mediaamp import streaming
 from mediaamp.services import BaseService, Endpoint, services
-from mediaamp.exceptions import InvalidTokenError
+from mediaamp.cache import ResponseCache
+from mediaamp.exceptions import (
+    CircuitOpenError, ClientError, InvalidTokenError, JobFailed, MediaAmpError, NotFound,
+    ServerError,
+)
+from mediaamp.jsoncodec import JSONCodec, available_codecs, get_codec
+from mediaamp.metrics import MetricsCollector
+from mediaamp.mirror import Mirror
+from mediaamp.pipeline import Pipeline, Stage
+from mediaamp.pool import PoolConfig
+from mediaamp.ratelimit import RateLimiter, TokenBucket
+from mediaamp.records import Records
+from mediaamp.registry import ServiceIndex
+from mediaamp.retry import RetryPolicy
+from mediaamp.routing import ReadRouting
+from mediaamp.store import FileStore, MemoryStore
+from mediaamp.sync import ChangeEvent, NotificationSync
+from mediaamp.tenants import SessionPool
 from mediaamp.utils import decode_datetime, encode_datetime
+from mediaamp.watch import task_watcher
 
 import mock
 import pytest
@@ -35,12 +59,12 @@ def session(registry):
 def test_invalid_token_response(session):
     get = mock.Mock()
     get.status_code = 200
-    get.json.return_value = {
+    get.content = json.dumps({
         'isException': True,
         'responseCode': 401,
         'description': 'Invalid security token.',
         'title': 'com.theplatform.authentication.api.exception.InvalidTokenException',
-    }
+    }).encode('utf-8')
     session.session.get.return_value = get
     with pytest.raises(InvalidTokenError):
         session.get('/home')
@@ -93,3 +117,947 @@ def test_datetimes():
     dt = decode_datetime(timestamp)
     assert dt.utcoffset() == datetime.timedelta(0)
     assert encode_datetime(dt) == timestamp
+
+
+def paged_session(total):
+    session = mock.Mock(account='fake')
+
+    def request_json(method, url, params=None, **kwargs):
+        first, last = [int(i) for i in params['range'].split('-')]
+        feed = {'entries': [{'id': i} for i in range(first, min(last, total) + 1)]}
+        if params.get('count') == 'true':
+            feed['totalResults'] = total
+        return feed
+    session.request_json.side_effect = request_json
+    return session
+
+
+@pytest.mark.parametrize('prefetch_pages', [False, True])
+def test_endpoint_iter_all(prefetch_pages):
+
+    class TestSvc(BaseService):
+        TestEnd = Endpoint(path='data')
+
+    session = paged_session(25)
+    svc = TestSvc(session, url)
+    entries = list(svc.TestEnd.iter_all(page_size=10, prefetch_pages=prefetch_pages))
+    assert [e['id'] for e in entries] == list(range(1, 26))
+    ranges = [c[1]['params']['range'] for c in session.request_json.call_args_list]
+    assert ranges == ['1-10', '11-20', '21-30']
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_endpoint_fetch_all(ordered):
+
+    class TestSvc(BaseService):
+        TestEnd = Endpoint(path='data')
+
+    session = paged_session(95)
+    svc = TestSvc(session, url)
+    ids = [e['id'] for e in svc.TestEnd.fetch_all(page_size=10, workers=3, ordered=ordered)]
+    if ordered:
+        assert ids == list(range(1, 96))
+    else:
+        assert sorted(ids) == list(range(1, 96))
+    ranges = sorted(c[1]['params']['range'] for c in session.request_json.call_args_list)
+    assert len(ranges) == 10
+    assert '91-95' in ranges
+
+
+def mock_aiohttp_client(*payloads):
+    client = mock.MagicMock(closed=False)
+    responses = []
+    for payload in payloads:
+        response = mock.MagicMock(status=200)
+        response.read = mock.AsyncMock(return_value=json.dumps(payload).encode('utf-8'))
+        responses.append(response)
+    client.request.return_value.__aenter__.side_effect = responses
+    return client
+
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason='mediaamp.aio requires Python 3.6')
+def test_async_session_retries_invalid_token(registry):
+    aio = pytest.importorskip('mediaamp.aio')
+    import asyncio
+    session = aio.AsyncSession('fake', 'fake', 'fake', auth_token='expired',
+                               service_registry=registry)
+    session.session = mock_aiohttp_client(
+        {'isException': True, 'responseCode': 401, 'description': 'Invalid security token.'},
+        {'signInResponse': {'token': auth_token}},
+        {'entries': [{'id': 1}]},
+    )
+    media_data = session['Media Data Service']
+    loop = asyncio.new_event_loop()
+    try:
+        feed = loop.run_until_complete(media_data.Media.get())
+    finally:
+        loop.close()
+    assert feed == {'entries': [{'id': 1}]}
+    assert session.auth_token == auth_token
+    methods = [c[0][0] for c in session.session.request.call_args_list]
+    assert methods == ['GET', 'GET', 'GET']
+    headers = session.session.request.call_args[1]['headers']
+    assert headers == aio.basic_auth('', auth_token)
+
+    # helpers built on synchronous requests refuse to run instead of
+    # calling methods on coroutines
+    media = media_data.Media
+    for helper in (media.iter_all, media.fetch_all, lambda: media.bulk_create([{}])):
+        with pytest.raises(MediaAmpError) as excinfo:
+            list(helper())
+        assert 'AsyncSession' in str(excinfo.value)
+    with pytest.raises(MediaAmpError):
+        media.stream(records=True)
+    assert session.session.request.call_count == 3
+
+
+def test_concurrent_token_refresh_signs_in_once(registry):
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token='expired',
+                               service_registry=registry)
+    # threading.Barrier is not available on Python 2
+    expired = []
+    all_expired = threading.Condition()
+
+    def get(url, auth=None, **kwargs):
+        if auth.password == 'expired':
+            with all_expired:
+                expired.append(url)
+                all_expired.notify_all()
+                while len(expired) < 16:
+                    all_expired.wait()
+            return http_response(payload={
+                'isException': True,
+                'responseCode': 401,
+                'description': 'Invalid security token.',
+            })
+        return http_response(payload={'entries': []})
+    session.session = mock.Mock()
+    session.session.get.side_effect = get
+
+    def _sign_in():
+        time.sleep(0.05)
+        session.auth_token = auth_token
+        session.post_sign_in.send(session)
+    session.sign_in = mock.Mock(side_effect=_sign_in)
+    signals = []
+    session.post_sign_in.connect(signals.append, weak=False)
+
+    threads = [threading.Thread(target=session.get, args=(url,)) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.sign_in.call_count == 1
+    assert len(signals) == 1
+    assert session.session.get.call_count == 32
+
+
+def signin_session(registry, **kwargs):
+    session = mediaamp.Session('fake', 'fake', 'fake', service_registry=registry, **kwargs)
+    tokens = iter('token-%d' % i for i in range(1000))
+
+    def get(url, **kwargs):
+        if url == session.signin_url:
+            return http_response(payload={'signInResponse': {'token': next(tokens)}})
+        return http_response(payload={'entries': []})
+    session.session = mock.Mock()
+    session.session.get.side_effect = get
+    return session
+
+
+def test_lazy_token_renewal(registry):
+    session = signin_session(registry, token_renewal='lazy')
+    session.get(url)
+    assert session.auth_token == 'token-0'
+    session.token_issued_at -= session.token_duration / 1000.0
+    session.get(url)
+    assert session.auth_token == 'token-1'
+    urls = [c[0][0] for c in session.session.get.call_args_list]
+    assert urls == [session.signin_url, url, session.signin_url, url]
+
+
+def test_background_token_renewal(registry):
+    session = signin_session(registry, token_renewal='background',
+                             token_duration=300, token_renewal_margin=200)
+    try:
+        session.sign_in()
+        deadline = time.time() + 2
+        while session.auth_token in ('token-0', 'token-1') and time.time() < deadline:
+            time.sleep(0.01)
+        assert session.auth_token not in ('token-0', 'token-1')
+    finally:
+        session.close()
+
+    # a token in constant use isn't renewed at every idle timeout
+    session = signin_session(registry, token_renewal='background', token_duration=3000,
+                             token_idle_timeout=400, token_renewal_margin=100)
+    try:
+        session.sign_in()
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            session.get(url)
+            time.sleep(0.02)
+        assert session.auth_token == 'token-0'
+    finally:
+        session.close()
+
+
+def test_file_store_shares_token_and_registry(tmpdir, registry):
+    store = FileStore(str(tmpdir))
+    first = signin_session(registry, store=store)
+    first.get(url)
+    second = signin_session(registry, store=store)
+    assert second.auth_token == first.auth_token == 'token-0'
+
+    first.refresh_token('token-0')
+    assert second.refresh_token('token-0') == 'token-1'
+    assert second.session.get.call_count == 0
+
+    resolving = mediaamp.Session('fake', 'fake', 'fake', store=store)
+    resolving.resolve_domain = mock.Mock(return_value=registry)
+    assert resolving.registry == registry
+    reusing = mediaamp.Session('fake', 'fake', 'fake', store=store)
+    reusing.resolve_domain = mock.Mock()
+    assert reusing.registry == registry
+    assert not reusing.resolve_domain.called
+
+
+def test_services_are_cached_and_endpoints_bound_per_session(registry):
+    first = mediaamp.Session('fake', 'fake', 'account-1', service_registry=registry)
+    second = mediaamp.Session('fake', 'fake', 'account-2', service_registry=registry)
+    media_data = first['Media Data Service']
+    assert first['Media Data Service'] is media_data
+    assert second['Media Data Service'] is not media_data
+    assert media_data.Media.default_params['account'] == 'account-1'
+    assert second['Media Data Service'].Media.default_params['account'] == 'account-2'
+    assert media_data.Media.service is media_data
+    assert media_data.Notifications.urljoin().endswith('/notify')
+    assert services['Media Data Service'].Media.service is None
+
+
+def test_endpoint_bulk_write_isolates_failures():
+
+    class TestSvc(BaseService):
+        TestEnd = Endpoint(path='data')
+
+    session = mock.Mock(account='fake', transport_errors=(requests.ConnectionError,))
+
+    def request_json(method, url, json=None, **kwargs):
+        entries = json['entries']
+        if any(e['title'] == 'bad' for e in entries):
+            raise ClientError('Invalid title.')
+        if any(e['title'] == 'reset' for e in entries):
+            raise requests.ConnectionError('Connection reset.')
+        return {'entries': [dict(e, id=e['title']) for e in entries]}
+    session.request_json.side_effect = request_json
+
+    svc = TestSvc(session, url)
+    titles = ['a', 'b', 'bad', 'c', 'd']
+    results = list(svc.TestEnd.bulk_create(({'title': t} for t in titles), batch_size=2))
+    assert [r.index for r in results] == list(range(5))
+    assert [r.result and r.result['id'] for r in results] == ['a', 'b', None, 'c', 'd']
+    assert isinstance(results[2].error, ClientError)
+    # one call per batch plus one for each entry of the rejected batch
+    assert session.request_json.call_count == 5
+    assert session.request_json.call_args[0][0] == 'post'
+
+    # a batch failing in transit may have been applied, it is only resent
+    # entry by entry when idempotent
+    titles = ['a', 'b', 'c', 'reset', 'e', 'f']
+    results = list(svc.TestEnd.bulk_create(({'title': t} for t in titles), batch_size=2))
+    assert [r.index for r in results] == list(range(6))
+    assert [r.result and r.result['id'] for r in results] == ['a', 'b', None, None, 'e', 'f']
+    assert isinstance(results[2].error, requests.ConnectionError)
+    session.request_json.reset_mock()
+    results = list(svc.TestEnd.bulk_update(({'title': t} for t in titles), batch_size=2,
+                                           idempotent=True))
+    assert [r.result and r.result['id'] for r in results] == ['a', 'b', 'c', None, 'e', 'f']
+    assert session.request_json.call_count == 5
+
+    # a response that doesn't match the batch fails its entries
+    session.request_json.side_effect = lambda *args, **kwargs: {'entries': []}
+    results = list(svc.TestEnd.bulk_update([{'title': 'a'}, {'title': 'b'}]))
+    assert [r.result for r in results] == [None, None]
+    assert all(isinstance(r.error, MediaAmpError) for r in results)
+
+
+def http_response(status_code=200, payload=None, headers=None):
+    response = mock.Mock(status_code=status_code, text='error', headers=headers or {})
+    response.content = json.dumps(payload if payload is not None else {}).encode('utf-8')
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(response=response)
+    return response
+
+
+def test_retry_policy_retries_idempotent_requests(registry):
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, retry=RetryPolicy(backoff=0))
+    session.session = mock.Mock()
+    session.session.get.side_effect = [
+        http_response(503, headers={'Retry-After': '0'}),
+        http_response(payload={'entries': []}),
+    ]
+    assert session.get(url) == {'entries': []}
+
+    session.session.post.side_effect = [http_response(503), http_response()]
+    with pytest.raises(ServerError):
+        session.post(url)
+    session.session.post.side_effect = [http_response(503), http_response()]
+    assert session.post(url, idempotent=True) == {}
+
+    # a Retry-After longer than the policy allows is raised, not slept on
+    session.session.get.side_effect = [
+        http_response(503, headers={'Retry-After': '86400'}),
+        http_response(payload={'entries': []}),
+    ]
+    with pytest.raises(ServerError):
+        session.get(url)
+    assert RetryPolicy(max_backoff=5).delay(1, mock.Mock(retry_after='3')) == 3
+    assert RetryPolicy(max_backoff=5).delay(1, mock.Mock(retry_after='30')) == 5
+
+
+def test_circuit_breaker_fails_fast(registry):
+    policy = RetryPolicy(max_attempts=1, breaker_threshold=2, breaker_reset=60)
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, retry=policy)
+    session.session = mock.Mock()
+    session.session.get.return_value = http_response(500)
+    for _ in range(2):
+        with pytest.raises(ServerError):
+            session.get(url)
+    with pytest.raises(CircuitOpenError):
+        session.get(url)
+    assert session.session.get.call_count == 2
+    assert policy.breaker(url).state == 'open'
+
+
+def test_rate_limiter_buckets_per_account_and_service(registry):
+    bucket = TokenBucket(10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.09 < bucket.reserve() <= 0.1
+
+    limiter = RateLimiter({'Publish Service': (5, 1)})
+    assert limiter.bucket('fake', 'Media Data Service') is None
+    assert limiter.bucket('fake', 'Publish Service') is limiter.bucket('fake', 'Publish Service')
+    assert limiter.bucket('other', 'Publish Service') is not limiter.bucket('fake', 'Publish Service')
+
+    limiter.acquire = mock.Mock()
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, rate_limiter=limiter)
+    session.session = mock.Mock()
+    session.session.get.return_value = http_response()
+    session['Publish Service'].Publish.get()
+    limiter.acquire.assert_called_once_with('fake', 'Publish Service')
+
+
+def streamed_response(payload, chunk_size):
+    body = json.dumps(payload).encode('utf-8')
+    response = http_response()
+    response.iter_content.return_value = [
+        body[i:i + chunk_size] for i in range(0, len(body), chunk_size)
+    ]
+    return response
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_stream_json_decodes_entries_incrementally(registry, chunk_size):
+    feed = {
+        'startIndex': 1,
+        'entries': [{'id': i, 'title': u'caf\xe9 %d' % i, 'ratio': 12.5} for i in range(20)],
+        'totalResults': 20,
+    }
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token='expired',
+                               service_registry=registry)
+    session.refresh_token = mock.Mock()
+    session.session = mock.Mock()
+    session.session.get.side_effect = [
+        streamed_response({
+            'isException': True,
+            'responseCode': 401,
+            'description': 'Invalid security token.',
+        }, chunk_size),
+        streamed_response(feed, chunk_size),
+    ]
+    header = {}
+    entries = session['Media Data Service'].Media.stream(header=header)
+    assert list(entries) == feed['entries']
+    assert header == {'startIndex': 1, 'totalResults': 20}
+    session.refresh_token.assert_called_once_with('expired')
+    assert session.session.get.call_args[1]['stream'] is True
+
+
+def test_feed_decoder_numbers_split_at_every_byte():
+    body = ('{"totalResults": 1.5e+3, "entries": [-12.25, {"id": 1.5}, 7, 2E-2, true],'
+            ' "itemsPerPage": -0.5}').encode('utf-8')
+    expected = json.loads(body.decode('utf-8'))
+    for split in range(len(body) + 1):
+        decoder = streaming.FeedDecoder()
+        entries = decoder.feed(body[:split]) + decoder.feed(body[split:]) + decoder.close()
+        assert entries == expected['entries'], split
+        assert decoder.header == {'totalResults': 1500.0, 'itemsPerPage': -0.5}
+
+    # a large entry arriving in small chunks is not decoded once per chunk
+    body = json.dumps({'entries': [{'description': 'x' * 100000}]}).encode('utf-8')
+    decoder = streaming.FeedDecoder()
+    with mock.patch.object(streaming, '_decoder', mock.Mock(wraps=streaming._decoder)) as spy:
+        entries = []
+        for i in range(0, len(body), 100):
+            entries.extend(decoder.feed(body[i:i + 100]))
+        entries.extend(decoder.close())
+    assert len(entries[0]['description']) == 100000
+    assert spy.raw_decode.call_count < 30
+
+
+def test_json_codecs(registry):
+    payload = {'entries': [{'title': u'caf\xe9', 'updated': 1435037606000, 'approved': True}]}
+    for codec in available_codecs():
+        assert codec.loads(codec.dumps(payload)) == payload
+        assert get_codec(codec.name).name == codec.name
+    assert isinstance(available_codecs()[-1], JSONCodec)
+    with pytest.raises(ValueError):
+        get_codec('nope')
+
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, codec='json')
+    session.session = mock.Mock()
+    session.session.put.return_value = http_response()
+    session['Media Data Service'].Media.put(json=payload)
+    sent = session.session.put.call_args[1]
+    assert 'json' not in sent
+    assert json.loads(sent['data'].decode('utf-8')) == payload
+
+
+def test_response_cache(registry):
+    cache = ResponseCache(maxsize=2, ttl=60)
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, cache=cache)
+    session.session = mock.Mock()
+    session.session.get.return_value = http_response(payload={'title': 'a'}, headers={'ETag': '"1"'})
+    session.session.put.return_value = http_response()
+    media = session['Media Data Service'].Media
+
+    assert media.get('1') == media.get('1') == {'title': 'a'}
+    assert session.session.get.call_count == 1
+    assert cache.stats()['hits'] == 1
+
+    media.put('1', json={'title': 'b'})
+    media.get('1')
+    assert session.session.get.call_count == 2
+    assert cache.stats()['invalidations'] == 1
+
+    for entry in cache._entries.values():
+        entry['expires_at'] = 0
+    session.session.get.return_value = http_response(status_code=304)
+    assert media.get('1') == {'title': 'a'}
+    assert session.session.get.call_args[1]['headers'] == {'If-None-Match': '"1"'}
+    assert cache.stats()['revalidations'] == 1
+
+    media.get('2', use_cache=False)
+    media.get('3')
+    media.get('4')
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size'] == 2
+
+    # responses evicted from memory are still served from the store, until
+    # they expire or a write invalidates them
+    store = MemoryStore()
+    session.cache = cache = ResponseCache(maxsize=1, ttl=60, store=store)
+    session.session.get.reset_mock()
+    session.session.get.return_value = http_response(payload={'title': 'a'})
+    media.get('1')
+    media.get('2')
+    media.get('1')
+    assert session.session.get.call_count == 2
+    assert all(expires_at is not None for _, expires_at in store._data.values())
+
+    media.get('2')
+    media.put('1', json={'title': 'b'})
+    session.session.get.return_value = http_response(payload={'title': 'b'})
+    assert media.get('1') == {'title': 'b'}
+    assert media.get('2') == {'title': 'a'}
+    assert session.session.get.call_count == 3
+
+    media.get('1')
+    media.put(json={'entries': []})
+    assert media.get('2') == {'title': 'b'}
+    assert session.session.get.call_count == 4
+
+
+def test_coalesced_gets_share_one_request(registry):
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, coalesce=True)
+    release = threading.Event()
+    results = []
+
+    def get(url, **kwargs):
+        release.wait()
+        if url.endswith('missing'):
+            return http_response(404)
+        return http_response(payload={'title': 'a'})
+    session.session = mock.Mock()
+    session.session.get.side_effect = get
+
+    def fetch(path):
+        try:
+            results.append(session.get(url + path, params={'schema': '1.0'}))
+        except NotFound as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=fetch, args=(path,))
+               for path in ['/1'] * 8 + ['/missing'] * 4]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert session.session.get.call_count == 2
+    assert results.count({'title': 'a'}) == 8
+    assert len([r for r in results if isinstance(r, NotFound)]) == 4
+
+
+def test_notification_sync(registry):
+    media_url = 'http://data.media.theplatform.com/media/data/Media/'
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry)
+    notifications = [
+        [{'id': 10}],
+        [
+            {'id': 11, 'method': 'put', 'type': 'Media', 'entry': {'id': media_url + '1'}},
+            {'id': 12, 'method': 'post', 'type': 'Media', 'entry': {'id': media_url + '2'}},
+            {'id': 13, 'method': 'put', 'type': 'Media', 'entry': {'id': media_url + '1'}},
+            {'id': 14, 'method': 'delete', 'type': 'Media', 'entry': {'id': media_url + '3'}},
+        ],
+    ]
+
+    def request_json(method, url, params=None, **kwargs):
+        if url.endswith('/notify'):
+            return notifications.pop(0)
+        ids = params['byId'].split('|')
+        return {'entries': [{'id': media_url + i, 'title': i} for i in ids]}
+    session.request_json = mock.Mock(side_effect=request_json)
+
+    store = MemoryStore()
+    sync = NotificationSync(session, {'Media Data Service': ['Media']}, store=store)
+    assert sync.poll() == []
+    sync.commit()
+    events = sync.poll()
+    assert [(e.object_id[-1], e.method, e.sequence) for e in events] == [
+        ('2', 'post', 12), ('1', 'put', 13), ('3', 'delete', 14)
+    ]
+    assert [e.entry and e.entry['title'] for e in events] == ['2', '1', None]
+    refetch = session.request_json.call_args_list[-1]
+    assert refetch[1]['params']['byId'] == '2|1'
+    sync.commit()
+    assert NotificationSync(session, {'Media Data Service': ['Media']},
+                            store=store).sequences == {'Media Data Service': 14}
+
+
+def test_mirror_answers_queries_locally(registry):
+    media_url = 'http://data.media.theplatform.com/media/data/Media/'
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry)
+    catalog = [
+        {'id': media_url + str(i), 'title': 'Title %d' % i, 'updated': 1400000000000 + i * 1000,
+         'categories': [{'name': 'News' if i % 2 else 'Sports'}], 'pl1$show': 'show%d' % (i % 3)}
+        for i in range(1, 11)
+    ]
+
+    def request_json(method, url, params=None, **kwargs):
+        entries = catalog
+        if 'byUpdated' in params:
+            entries = [e for e in catalog if e['updated'] >= 1400000009000]
+        first, last = [int(i) for i in params['range'].split('-')]
+        return {'entries': entries[first - 1:last], 'totalResults': len(entries)}
+    session.request_json = mock.Mock(side_effect=request_json)
+
+    mirror = Mirror(session['Media Data Service'].Media)
+    assert mirror.load(page_size=4) == 10
+    assert session.request_json.call_args[1]['params']['form'] == 'cjson'
+
+    feed = mirror.get(params={'byCategories': 'News', 'byCustomValue': '{show}{show1|show2}',
+                              'sort': 'updated|desc', 'range': '1-2', 'count': 'true'})
+    assert [e['title'] for e in feed['entries']] == ['Title 7', 'Title 5']
+    assert feed['totalResults'] == 3
+    assert mirror.get('4', params={'fields': 'title'}) == {'title': 'Title 4'}
+    feed = mirror.get(params={'byUpdated': '2014-05-13T16:53:28Z~', 'fields': 'id'})
+    assert len(feed['entries']) == 3
+    with pytest.raises(ValueError):
+        mirror.get(params={'q': 'title:foo'})
+
+    catalog[9] = dict(catalog[9], title='Renamed')
+    assert mirror.refresh() == 2
+    assert mirror.get('10')['title'] == 'Renamed'
+    assert 'byUpdated' in session.request_json.call_args[1]['params']
+
+    mirror.apply([ChangeEvent('Media Data Service', 'Media', 'delete', media_url + '1', 1, None)])
+    assert mirror.get('1') is None
+    assert mirror.get(params={'count': 'true'})['totalResults'] == 9
+
+    cafe = dict(catalog[1], title=u'Caf\xe9', categories=[{'name': u'Cin\xe9ma'}])
+    mirror.upsert([cafe])
+    feed = mirror.get(params={'byTitle': u'Caf\xe9', 'byCategories': u'Cin\xe9ma',
+                              'fields': u'id,title'})
+    assert feed['entries'] == [{'id': cafe['id'], 'title': u'Caf\xe9'}]
+
+
+def test_pooled_adapter_config_and_stats(registry):
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', '2')])
+        return [b'{}']
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever).start()
+    try:
+        session = mediaamp.Session('fake', 'fake', 'fake', service_registry=registry,
+                                   pool=PoolConfig(maxsize=3, timeout=5))
+        context = session.pool.ssl_context
+        if hasattr(ssl, 'TLSVersion'):
+            assert context.minimum_version == ssl.TLSVersion.TLSv1_2
+        else:  # Python < 3.7
+            assert context.options & ssl.OP_NO_TLSv1_1
+        base = 'http://127.0.0.1:%s/' % server.server_port
+        for _ in range(3):
+            session.session.get(base).content
+        stats = session.pool_stats()[base.rstrip('/')]
+        assert stats == {'maxsize': 3, 'in_use': 0, 'idle': 1,
+                         'connections_opened': 1, 'requests': 3}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_signals_and_metrics(registry):
+    session = signin_session(registry)
+    metrics = MetricsCollector().attach(session)
+    before = []
+    session.pre_request.connect(lambda sender, event, request: before.append(event), weak=False)
+
+    session.session.post.return_value = http_response(payload={'entries': []})
+    media = session['Media Data Service'].Media
+    media.get()
+    media.post(json={'entries': [{'title': 'a'}]})
+    session.session.get.side_effect = None
+    session.session.get.return_value = http_response(503)
+    with pytest.raises(ServerError):
+        media.get()
+
+    assert [(e.endpoint, e.method, e.status) for e in before] == [
+        ('signIn', 'get', 200), ('Media', 'get', 200), ('Media', 'post', 200), ('Media', 'get', 503)
+    ]
+    summary = metrics.summary()
+    media_get = summary[('Media Data Service', 'Media', 'get')]
+    assert media_get['count'] == 2
+    assert media_get['errors'] == 1
+    assert media_get['statuses'] == {200: 1, 503: 1}
+    assert media_get['p50'] <= media_get['p99']
+    assert summary[('Media Data Service', 'Media', 'post')]['request_bytes'] == len(
+        b'{"entries":[{"title":"a"}]}')
+    assert metrics.token_refreshes == {'sign_in': 1}
+    text = metrics.prometheus()
+    assert ('mediaamp_requests_total{endpoint="Media",method="get",'
+            'service="Media Data Service"} 2') in text
+    assert 'quantile="0.99"' in text
+
+
+def test_fields_and_records():
+
+    class TestSvc(BaseService):
+        TestEnd = Endpoint(path='data')
+
+    session = paged_session(5)
+    svc = TestSvc(session, url)
+    timestamp = 1435037607000
+    session.request_json.side_effect = lambda method, url, params=None, **kw: {'entries': [
+        {'id': 1, 'title': 'One', 'updated': timestamp, 'pl1$show': 'Show'}
+    ]}
+    svc.TestEnd.get(fields=u'id,title')
+    assert session.request_json.call_args[1]['params']['fields'] == 'id,title'
+    records = list(svc.TestEnd.iter_all(fields=['id', 'updated', 'pl1$show', 'guid'], records=True))
+    assert session.request_json.call_args[1]['params']['fields'] == 'id,updated,pl1$show,guid'
+    record, = records
+    assert not hasattr(record, '__dict__')
+    assert record.pl1_show == record['pl1$show'] == 'Show'
+    assert record.guid is None
+    assert record.updated == decode_datetime(timestamp)
+    assert record.raw('updated') == timestamp
+    assert record._asdict() == {'id': 1, 'updated': timestamp, 'pl1$show': 'Show', 'guid': None}
+
+    to_record = Records()
+    first = to_record({'id': 1, 'title': 'a'})
+    assert type(to_record({'id': 2, 'title': 'b'})) is type(first)
+    assert first.title == 'a'
+
+    # workers racing on a new set of keys share one type
+    start = threading.Event()
+    types = []
+
+    def convert():
+        start.wait()
+        types.append(type(to_record({'id': 3, 'guid': 'c'})))
+    threads = [threading.Thread(target=convert) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    assert len(set(types)) == 1
+
+    to_record = Records(max_types=2)
+    for i in range(5):
+        to_record({'field%d' % i: i})
+    assert list(to_record._types) == [('field3',), ('field4',)]
+    assert Records(u'id,title').fields == ('id', 'title')
+
+
+def test_session_pool_shares_connections_and_token(registry):
+    http = mock.Mock()
+    tokens = iter('token-%d' % i for i in range(1000))
+
+    def get(url, params=None, **kwargs):
+        if url.endswith('/signIn'):
+            return http_response(payload={'signInResponse': {'token': next(tokens)}})
+        if params['account'] == 'account-3':
+            return http_response(404)
+        return http_response(payload={'entries': [{'ownerId': params['account']}]})
+    http.get.side_effect = get
+
+    class MockedSession(mediaamp.Session):
+        def create_http_session(self):
+            return http
+
+    accounts = ['account-1', 'account-2', 'account-3']
+    pool = SessionPool('fake', 'fake', accounts, session_class=MockedSession,
+                       service_registry=registry)
+    results = list(pool.query('Media Data Service', 'Media', params={'byTitle': 'x'}))
+    assert [r.account for r in results] == accounts
+    assert [r.result['entries'][0]['ownerId'] for r in results[:2]] == accounts[:2]
+    assert isinstance(results[2].error, NotFound)
+    signins = [c for c in http.get.call_args_list if c[0][0].endswith('/signIn')]
+    assert len(signins) == 1
+    assert len(set(pool[a].auth_token for a in accounts)) == 1
+    assert all(pool[a].session is http for a in accounts)
+
+    merged = pool.query_merged('Media Data Service', 'Media')
+    assert merged['entryCount'] == 2
+    assert list(merged['errors']) == ['account-3']
+
+
+def test_pipeline_checkpoints_and_resumes():
+    calls = []
+    broken = {'c'}
+
+    def create(item):
+        calls.append(('create', item['guid']))
+        return dict(item, media_id='m-' + item['guid'])
+
+    def link(item):
+        calls.append(('link', item['guid']))
+        if item['guid'] in broken:
+            raise ValueError('no file')
+        return dict(item, linked=True)
+
+    def make_pipeline():
+        stages = [Stage('create', create, workers=2), Stage('link', link, workers=3)]
+        return Pipeline(stages, key=lambda item: item['guid'], store=store, queue_size=2)
+
+    store = MemoryStore()
+    items = [{'guid': guid} for guid in 'abcdef']
+    pipeline = make_pipeline()
+    results = dict((r.key, r) for r in pipeline.run(items))
+    assert sorted(results) == list('abcdef')
+    assert results['c'].stage == 'link'
+    assert isinstance(results['c'].error, ValueError)
+    assert results['a'].item == {'guid': 'a', 'media_id': 'm-a', 'linked': True}
+    stats = pipeline.stats()
+    assert stats['create']['processed'] == 6
+    assert (stats['link']['processed'], stats['link']['failed']) == (5, 1)
+
+    broken.clear()
+    del calls[:]
+    pipeline = make_pipeline()
+    results = list(pipeline.run(items))
+    assert [(r.key, r.error) for r in results] == [('c', None)]
+    assert results[0].item['media_id'] == 'm-c'
+    assert calls == [('link', 'c')]
+    assert pipeline.skipped == 5
+
+    # items without a key are reported and the others still run
+    pipeline = Pipeline([Stage('create', create)], key=lambda item: item['guid'])
+    results = list(pipeline.run([{'guid': 'x'}, {}, {'guid': 'y'}]))
+    assert sorted(r.key for r in results if r.key) == ['x', 'y']
+    assert [(r.item, r.stage) for r in results if r.key is None] == [({}, None)]
+    assert isinstance([r for r in results if r.key is None][0].error, KeyError)
+
+    # a failing checkpoint store fails the item instead of hanging the run
+    failing = MemoryStore()
+    failing.set = mock.Mock(side_effect=IOError('disk full'))
+    pipeline = Pipeline([Stage('create', create), Stage('link', link)],
+                        key=lambda item: item['guid'], store=failing)
+    results = list(pipeline.run([{'guid': 'x'}, {'guid': 'y'}]))
+    assert sorted((r.key, r.stage) for r in results) == [('x', 'create'), ('y', 'create')]
+    assert all(isinstance(r.error, IOError) for r in results)
+
+
+def test_status_watcher_batches_polls(registry):
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry)
+    task_url = 'http://data.task.theplatform.com/task/data/Task/'
+    statuses = {}
+
+    def request_json(method, url, params=None, **kwargs):
+        return {'entries': [{'id': task_url + i, 'status': statuses.get(i, 'Processing')}
+                            for i in params['byId'].split('|')]}
+    session.request_json = mock.Mock(side_effect=request_json)
+
+    watcher = task_watcher(session, batch_size=100, min_interval=0.01, max_interval=0.05)
+    completed = []
+    watcher.completed.connect(lambda sender, entry, error: completed.append(entry['id']),
+                              weak=False)
+    with watcher:
+        futures = dict((str(i), watcher.watch(task_url + str(i))) for i in range(250))
+        time.sleep(0.1)
+        assert not any(f.done() for f in futures.values())
+        for i in range(250):
+            statuses[str(i)] = 'Failed' if i == 7 else 'Complete'
+        assert futures['3'].result(timeout=5)['status'] == 'Complete'
+        with pytest.raises(JobFailed):
+            futures['7'].result(timeout=5)
+        for future in futures.values():
+            future.exception(timeout=5)
+    assert len(completed) == 250
+    assert watcher.pending == 0
+    batches = [c[1]['params']['byId'].split('|') for c in session.request_json.call_args_list]
+    assert max(len(batch) for batch in batches) == 100
+    assert session.request_json.call_args[1]['params']['fields'] == 'id,status'
+
+    statuses.clear()
+    with watcher:
+        future = watcher.watch(task_url + 'stuck')
+    assert future.cancelled()
+    assert watcher.pending == 0
+
+    # a future cancelled while its batch is in flight is left cancelled
+    watcher = task_watcher(session)
+    watcher.start = lambda: None
+    completed = []
+    watcher.completed.connect(lambda sender, entry, error: completed.append(entry['id']),
+                              weak=False)
+    cancelled, done = watcher.watch('1'), watcher.watch('2')
+
+    def cancel_then_complete(method, url, params=None, **kwargs):
+        cancelled.cancel()
+        return {'entries': [{'id': task_url + i, 'status': 'Complete'}
+                            for i in params['byId'].split('|')]}
+    session.request_json.side_effect = cancel_then_complete
+    assert watcher.poll() == 1
+    assert cancelled.cancelled()
+    assert done.result()['id'] == task_url + '2'
+    assert completed == [task_url + '2']
+
+
+def test_service_index(registry):
+    index = ServiceIndex(dict(registry, **{'Only Read Service read-only': 'http://read.x.com/x'}))
+    media = index.hosts('Media Data Service')
+    assert media.primary == 'https://data.media.theplatform.com/media'
+    assert index.url('Media Data Service', read_only=True) == \
+        'https://read.data.media.theplatform.com/media'
+    assert index.url('Only Read Service') == 'https://read.x.com/x'
+    assert index.variants('Access Data Service') == ['audience', 'master']
+    audience = index.hosts('Access Data Service audience')
+    assert (audience.service, audience.variant) == ('Access Data Service', 'audience')
+    assert 'Media Data Service read-only' not in index
+    with pytest.raises(KeyError):
+        index.url('Missing Service')
+
+    session = mediaamp.Session('fake', 'fake', 'fake', service_registry=registry)
+    assert session.service_index is session.service_index
+    access = session['Access Data Service audience']
+    assert type(access) is type(session['Access Data Service'])
+    assert access.base_url == 'https://enduser.access.auth.theplatform.com'
+    assert services['Media Data Service'].__name__ == 'MediaDataService'
+
+
+def test_read_routing_to_read_only_hosts(registry):
+    routing = ReadRouting(pin_window=60, failure_threshold=1)
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, routing=routing)
+    session.session = mock.Mock()
+    session.session.get.return_value = http_response(payload={'entries': []})
+    session.session.post.return_value = http_response(payload={'id': 'created'})
+    media = session['Media Data Service'].Media
+    reader = 'https://read.data.media.theplatform.com/media/data/Media'
+    writer = 'https://data.media.theplatform.com/media/data/Media'
+
+    def requested_urls(method='get'):
+        calls = getattr(session.session, method).call_args_list
+        urls = [c[0][0] for c in calls]
+        getattr(session.session, method).reset_mock()
+        return urls
+
+    media.get()
+    assert requested_urls() == [reader]
+
+    # a failing read-only host falls back to the primary, then is skipped
+    session.session.get.side_effect = [http_response(503), http_response(payload={})]
+    media.get()
+    assert requested_urls() == [reader, writer]
+    session.session.get.side_effect = None
+    media.get()
+    assert requested_urls() == [writer]
+
+    routing.breaker(reader).record(False)
+    # only writes that went through pin reads to the primary
+    session.session.post.return_value = http_response(400)
+    with pytest.raises(MediaAmpError):
+        media.post(json={'title': 'invalid'})
+    requested_urls('post')
+    media.get()
+    assert requested_urls() == [reader]
+
+    session.session.post.return_value = http_response(payload={'id': 'created'})
+    media.post(json={'title': 'new'})
+    assert requested_urls('post') == [writer]
+    media.get()
+    assert requested_urls() == [writer]
+    assert session['Media Data Service'].MediaFile.get() is not None
+    assert requested_urls() == [writer.replace('Media', 'MediaFile')]
+    stats = routing.stats()
+    assert (stats['replica_reads'], stats['primary_reads'], stats['failovers']) == (3, 3, 1)
+
+
+def test_read_routing_recovers_after_cache_hits_and_streams(registry):
+    routing = ReadRouting(failure_threshold=1, recovery_time=0)
+    session = mediaamp.Session('fake', 'fake', 'fake', auth_token=auth_token,
+                               service_registry=registry, routing=routing,
+                               cache=ResponseCache(ttl=60))
+    session.session = mock.Mock()
+    media = session['Media Data Service'].Media
+    reader = 'https://read.data.media.theplatform.com/media/data/Media'
+
+    session.session.get.side_effect = [http_response(503), http_response(payload={})]
+    media.get()
+    assert routing.stats()['unhealthy'] == ['read.data.media.theplatform.com']
+    media.get()     # answered from the cache, the read-only host isn't tried
+    assert session.session.get.call_count == 2
+
+    session.session.get.side_effect = None
+    session.session.get.return_value = http_response(payload={'entries': []})
+    media.get(params={'byTitle': 'x'})
+    assert session.session.get.call_args[0][0] == reader
+    assert routing.stats()['unhealthy'] == []
+
+    session.session.get.side_effect = [http_response(503),
+                                       streamed_response({'entries': [{'id': 1}]}, 4)]
+    assert [e['id'] for e in media.stream()] == [1]
+    assert routing.stats()['failovers'] == 2
+    session.session.get.side_effect = None
+    session.session.get.return_value = streamed_response({'entries': [{'id': 2}]}, 4)
+    assert [e['id'] for e in media.stream()] == [2]
+    assert session.session.get.call_args[0][0] == reader
+    assert routing.stats()['unhealthy'] == []